@@ -0,0 +1,121 @@
+"""Local stand-in for Almaviva API with configurable latency, errors,
+expired tokens and slot availability.
+
+Standalone usage:
+    python -m benchmarks.fake_almaviva --port 8081 --latency 0.2
+"""
+import argparse
+import asyncio
+from collections import Counter
+from dataclasses import dataclass
+from random import random, uniform
+from uuid import uuid4
+
+from aiohttp import web
+
+ALL_TIME_INTERVALS = (
+    '09:00', '09:30', '10:00', '10:30', '11:00', '11:30',
+    '12:00', '12:30', '13:00', '13:30', '14:00', '14:30'
+)
+
+
+@dataclass
+class FakeSettings:
+    latency: float = 0.1  # Mean response delay in seconds
+    jitter: float = 0.05  # Delay varies by +- jitter
+    error_rate: float = 0.0  # Share of 500 responses
+    unauthorized_rate: float = 0.0  # Share of 401 responses
+    free_rate: float = 0.01  # Chance of every time interval to be free
+    booking_rate: float = 0.0  # Chance of validation to succeed
+
+
+class FakeAlmaviva:
+    """aiohttp application which imitates login, slots and validation api.
+    Counts requests by endpoint and status."""
+
+    def __init__(self, settings: FakeSettings = None):
+        self.settings = settings or FakeSettings()
+        self.requests = Counter()
+        self.app = web.Application()
+        self.app.add_routes([
+            web.post('/api/login', self.login),
+            web.get('/api/sites/appointment-slots/', self.slots),
+            web.get('/api/sites/appointments-validation/', self.validation),
+        ])
+
+    async def delay(self):
+        settings = self.settings
+        await asyncio.sleep(max(0.0, uniform(
+            settings.latency - settings.jitter,
+            settings.latency + settings.jitter)))
+
+    def failure(self, endpoint: str, check_auth: bool = True
+                ) -> web.Response | None:
+        """Returns:
+            Error response chosen with configured rates or None.
+        """
+        if random() < self.settings.error_rate:
+            self.requests[(endpoint, 500)] += 1
+            return web.Response(status=500)
+        if check_auth and random() < self.settings.unauthorized_rate:
+            self.requests[(endpoint, 401)] += 1
+            return web.Response(status=401)
+
+    async def login(self, request: web.Request) -> web.Response:
+        await self.delay()
+        response = self.failure('login', check_auth=False)
+        if response is not None:
+            return response
+        self.requests[('login', 200)] += 1
+        return web.json_response({'accessToken': uuid4().hex})
+
+    async def slots(self, request: web.Request) -> web.Response:
+        await self.delay()
+        response = self.failure('slots')
+        if response is not None:
+            return response
+        self.requests[('slots', 200)] += 1
+        free_rate = self.settings.free_rate
+        return web.json_response([
+            {'time': time, 'freeSpots': int(random() < free_rate)}
+            for time in ALL_TIME_INTERVALS
+        ])
+
+    async def validation(self, request: web.Request) -> web.Response:
+        await self.delay()
+        response = self.failure('validation')
+        if response is not None:
+            return response
+        self.requests[('validation', 200)] += 1
+        booked = random() < self.settings.booking_rate
+        return web.Response(text='true' if booked else 'false')
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8081
+                    ) -> web.AppRunner:
+        """Starts server in the running event loop"""
+        runner = web.AppRunner(self.app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    defaults = FakeSettings()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    for name, value in vars(defaults).items():
+        parser.add_argument(f'--{name.replace("_", "-")}', type=float,
+                            default=value)
+
+
+def settings_from_args(args: argparse.Namespace) -> FakeSettings:
+    return FakeSettings(**{name: getattr(args, name)
+                           for name in vars(FakeSettings())})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = FakeAlmaviva(settings_from_args(args))
+    web.run_app(server.app, host=args.host, port=args.port, access_log=None)
@@ -0,0 +1,225 @@
+"""Runs N scanning users against the local fake Almaviva server and reports
+requests per second, request latency, event loop lag, SQLite writes and
+memory per user.
+
+Users are stored in a temporary database, their logs go to a temporary
+directory. The slot cache needs a running Redis, use a dedicated one
+('localhost' by default, see redis_host in config.py):
+    python -m benchmarks.load_test --users 1000 --duration 60
+"""
+import argparse
+import asyncio
+import os
+import resource
+import tempfile
+import tracemalloc
+from collections import defaultdict
+from datetime import date, timedelta
+from statistics import quantiles
+from types import SimpleNamespace
+from typing import Dict, List
+
+from aiohttp import TraceConfig
+from benchmarks.fake_almaviva import (FakeAlmaviva, add_arguments,
+                                      settings_from_args)
+
+# Telegram and encryption settings are not used, but config requires them
+BENCHMARK_ENVIRON = {
+    'key': 'benchmark',
+    'salt': 'benchmark',
+    'admin_id': '0',
+    'token': '0:benchmark',
+    'redis_host': 'localhost',
+}
+
+
+def percentile(values: List[float], percent: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return quantiles(values, n=100, method='inclusive')[percent - 1]
+
+
+def request_tracer(latencies: Dict[str, List[float]],
+                   errors: Dict[str, int]) -> TraceConfig:
+    """Returns:
+        TraceConfig which stores latency of every request by api endpoint.
+    """
+    async def on_request_start(session, context, params):
+        context.start = asyncio.get_running_loop().time()
+
+    async def on_request_end(session, context, params):
+        endpoint = params.url.path.rstrip('/').rsplit('/', 1)[-1]
+        latencies[endpoint].append(
+            asyncio.get_running_loop().time() - context.start)
+
+    async def on_request_exception(session, context, params):
+        errors[params.url.path] += 1
+
+    tracer = TraceConfig()
+    tracer.on_request_start.append(on_request_start)
+    tracer.on_request_end.append(on_request_end)
+    tracer.on_request_exception.append(on_request_exception)
+    return tracer
+
+
+async def monitor_loop_lag(lags: List[float], interval: float = 0.1):
+    """Measures how late the event loop wakes up a sleeping coroutine"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - expected)
+
+
+async def create_users(users: int, days: int) -> int:
+    """Inserts users with filled data. Cities are assigned in turn.
+    Returns:
+        Year of users' dates.
+    """
+    import db
+    from encrypting.encrypting import fernet
+    from scanner.templates.ru.cities import CITIES
+
+    start = date.today() + timedelta(1)
+    # Scanner dates are within one year
+    final = min(start + timedelta(days), date(start.year, 12, 31))
+    cities = sorted(CITIES)
+    for user_id in range(1, users + 1):
+        city = cities[user_id % len(cities)]
+        values = (
+            user_id,
+            fernet.encrypt(f'user{user_id}@example.com'.encode()),
+            fernet.encrypt(b'password'),
+            fernet.encrypt(city.encode()),
+            start.month, start.day, final.month, final.day,
+            fernet.encrypt(b'token'),
+        )
+        columns = (db.USER_ID, db.USERNAME_ALMA, db.PASSWORD_ALMA, db.CITY,
+                   db.ST_MONTH, db.ST_DAY, db.FIN_MONTH, db.FIN_DAY,
+                   db.AUTH_TOKEN)
+        await db.aio.insert_row(db.ACCOUNT, columns, values)
+    return start.year
+
+
+async def run(args: argparse.Namespace) -> SimpleNamespace:
+    # Modules read config on import, so environment is set up first
+    for name, value in BENCHMARK_ENVIRON.items():
+        os.environ.setdefault(name, value)
+    os.environ['almaviva_url'] = f'http://{args.host}:{args.port}/'
+    import db
+    import scanner.scanner as scanner
+    import telegram.loggers as loggers
+
+    workdir = tempfile.mkdtemp(prefix='almaviva_benchmark_')
+    db.sqlite.DB_PATH = os.path.join(workdir, 'users.db')
+    loggers.LOGS_DIR = workdir
+    db.create_all_tables()
+
+    server = FakeAlmaviva(settings_from_args(args))
+    runner = await server.start(args.host, args.port)
+
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    scanner.HTTP.trace_configs.append(request_tracer(latencies, errors))
+    scanner.POLLER.pause = tuple(args.pause)
+    if args.no_rate_limit:
+        scanner.RATE_LIMITER.limits = {}
+        scanner.RATE_LIMITER.site_limits = {}
+    year = await create_users(args.users, args.days)
+    scanner.YEAR = str(year)
+    scanner.CADENCE.year = year
+
+    lags = []
+    lag_monitor = asyncio.create_task(monitor_loop_lag(lags))
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if args.trace_memory:
+        tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    tasks = [asyncio.create_task(scanner.Appointment(user_id).run_scanning())
+             for user_id in range(1, args.users + 1)]
+    await asyncio.sleep(args.duration)
+    memory_after = tracemalloc.get_traced_memory()[0]
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for task in tasks + [lag_monitor]:
+        task.cancel()
+    await asyncio.gather(*tasks, lag_monitor, return_exceptions=True)
+    elapsed = loop.time() - started
+    tracemalloc.stop()
+
+    await db.aio.flush_buffer()
+    await db.aio.database.close()
+    await scanner.HTTP.close()
+    await scanner.REDIS_CLIENT.close(close_connection_pool=True)
+    await runner.cleanup()
+
+    if args.trace_memory:
+        memory = (memory_after - memory_before) / args.users
+    else:
+        # ru_maxrss is in kilobytes on Linux
+        memory = (rss_after - rss_before) * 1024 / args.users
+    all_latencies = [value for values in latencies.values()
+                     for value in values]
+    return SimpleNamespace(
+        users=args.users,
+        elapsed=elapsed,
+        requests=len(all_latencies),
+        rps=len(all_latencies) / elapsed,
+        latencies=latencies,
+        p50=percentile(all_latencies, 50),
+        p99=percentile(all_latencies, 99),
+        errors=sum(errors.values()),
+        server_requests=dict(server.requests),
+        lag_p50=percentile(lags, 50),
+        lag_p99=percentile(lags, 99),
+        lag_max=max(lags, default=0.0),
+        sqlite_writes=db.aio.database.writes,
+        memory_per_user=memory,
+        workdir=workdir,
+    )
+
+
+def print_report(result: SimpleNamespace):
+    print(f'Users:              {result.users}')
+    print(f'Duration:           {result.elapsed:.1f} s')
+    print(f'Requests:           {result.requests} '
+          f'({result.rps:.1f} req/s, {result.errors} client errors)')
+    print(f'Latency p50/p99:    {result.p50 * 1000:.1f} / '
+          f'{result.p99 * 1000:.1f} ms')
+    for endpoint, values in sorted(result.latencies.items()):
+        print(f'  {endpoint:<26} {len(values):>7} requests, '
+              f'p50 {percentile(values, 50) * 1000:.1f} ms, '
+              f'p99 {percentile(values, 99) * 1000:.1f} ms')
+    print(f'Server responses:   {result.server_requests}')
+    print(f'Loop lag p50/p99:   {result.lag_p50 * 1000:.1f} / '
+          f'{result.lag_p99 * 1000:.1f} ms (max '
+          f'{result.lag_max * 1000:.1f} ms)')
+    print(f'SQLite writes:      {result.sqlite_writes} '
+          f'({result.sqlite_writes / result.elapsed:.1f} rows/s)')
+    print(f'Memory per user:    {result.memory_per_user / 1024:.1f} KiB')
+    print(f'Database and logs:  {result.workdir}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test of the scanner against a fake Almaviva API')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=60,
+                        help='seconds to run scanning')
+    parser.add_argument('--days', type=int, default=30,
+                        help='length of every user dates window')
+    parser.add_argument('--pause', type=float, nargs=2, default=(0.5, 1),
+                        metavar=('MIN', 'MAX'),
+                        help='poller pause bounds, 5 10 in production')
+    parser.add_argument('--no-rate-limit', action='store_true',
+                        help='disable the global limit of requests rate')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='measure memory with tracemalloc instead of RSS')
+    add_arguments(parser)
+    print_report(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3 @@
+from .jobs import JobQueue, LOCAL, WORKERS
+from .ring import HashRing
+from .worker import Worker
@@ -0,0 +1,123 @@
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Set, \
+    Tuple
+
+import telegram.loggers as loggers
+from orjson import dumps, loads
+from redis.asyncio import Redis
+from .streams import read_group
+
+# Scan modes
+LOCAL = 'local'  # the bot process scans by itself
+WORKERS = 'workers'  # worker processes scan, the bot only sends jobs
+
+JOBS = 'scan:jobs'  # hash of user id and start token of every scan job
+COMMANDS = 'scan:commands'  # channel which wakes up workers
+WORKERS_KEY = 'scan:workers'  # sorted set of workers by last heartbeat
+RESULTS = 'scan:results'  # stream of finished scans
+RESULTS_GROUP = 'frontend'
+MAX_LEN = 10000  # about the latest results kept in the stream
+
+# (month, day, time interval, time intervals of extra appointments) of
+# successful appointment or None if dates are invalid or expired
+ScanResult = Tuple[str, str, str, List[str]] | None
+
+
+def shard(user_id: int, token: str) -> str:
+    """Returns:
+        Key which places the job on the hash ring: site id of the user's
+        city, so one worker polls all dates of the city. User id for jobs
+        started without site id.
+    """
+    _, _, site_id = token.partition(':')
+    return f'site:{site_id}' if site_id else str(user_id)
+
+
+class JobQueue:
+    """Scan jobs shared by the bot front-end and worker processes through
+    Redis. Front-end adds and removes jobs, workers claim them and send
+    results back.
+
+    Every job has a start token '<start time>:<site id>'. A new token of the
+    same user means restart, so workers restart the scan even if they
+    haven't seen it stopped."""
+
+    def __init__(self, redis: Redis):
+        self.redis = redis
+
+    async def start(self, user_id: int, site_id: int):
+        await self.start_many({user_id: site_id})
+
+    async def start_many(self, site_ids: Dict[int, int]):
+        """Starts jobs of users by user id and site id of their city"""
+        if not site_ids:
+            return
+        started = repr(time.time())
+        await self.redis.hset(JOBS, mapping={
+            user_id: f'{started}:{site_id}'
+            for user_id, site_id in site_ids.items()})
+        await self.redis.publish(COMMANDS, f'start {len(site_ids)}')
+
+    async def stop(self, user_id: int):
+        await self.stop_many((user_id,))
+
+    async def stop_many(self, user_ids: Iterable[int]):
+        user_ids = tuple(user_ids)
+        if not user_ids:
+            return
+        await self.redis.hdel(JOBS, *user_ids)
+        await self.redis.publish(COMMANDS, f'stop {len(user_ids)}')
+
+    async def jobs(self) -> Dict[int, str]:
+        """Returns:
+            Start tokens of all jobs by user id.
+        """
+        return {int(user_id): token.decode() for user_id, token
+                in (await self.redis.hgetall(JOBS)).items()}
+
+    async def active(self) -> Set[int]:
+        return {int(user_id) for user_id in await self.redis.hkeys(JOBS)}
+
+    async def finish(self, user_id: int, token: str, result: ScanResult):
+        """Sends result of the scan to front-end and removes the job unless
+        it was restarted meanwhile"""
+        await self.redis.xadd(
+            RESULTS,
+            {'user_id': user_id, 'result': dumps(result)},
+            maxlen=MAX_LEN,
+            approximate=True
+        )
+        await self.drop(user_id, token)
+
+    async def drop(self, user_id: int, token: str):
+        """Removes the job unless it was restarted meanwhile"""
+        current = await self.redis.hget(JOBS, user_id)
+        if current is not None and current.decode() == token:
+            await self.redis.hdel(JOBS, user_id)
+
+    async def read_results(
+            self, consumer: str,
+            handler: Callable[[int, ScanResult], Awaitable[None]]):
+        """Calls handler with every scan result. Front-end replicas share one
+        consumer group, so every result is handled once"""
+        await read_group(
+            self.redis, RESULTS, RESULTS_GROUP, consumer,
+            lambda fields: self.handle_result(fields, handler),
+            lambda error: loggers.log(0, str(error), loggers.ERROR),
+            start='0')
+
+    @staticmethod
+    async def handle_result(
+            fields: Dict[bytes, bytes],
+            handler: Callable[[int, ScanResult], Awaitable[None]]):
+        try:
+            user_id = int(fields[b'user_id'])
+            result = loads(fields[b'result'])
+        except (KeyError, ValueError) as error:
+            loggers.log(0, f'Malformed result {fields!r}: {error!r}',
+                        loggers.ERROR)
+            return
+        try:
+            await handler(user_id, tuple(result) if result else result)
+        except Exception as error:
+            loggers.log(user_id, str(error), loggers.ERROR)
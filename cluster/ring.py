@@ -0,0 +1,35 @@
+from bisect import bisect
+from hashlib import md5
+from typing import Hashable, Iterable
+
+REPLICAS = 100  # points of every node on the ring
+
+
+def ring_hash(value: str) -> int:
+    return int.from_bytes(md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hashing of keys to worker nodes. When a node joins or
+    leaves, only keys of its ring segments move to other nodes."""
+
+    def __init__(self, nodes: Iterable[str], replicas: int = REPLICAS):
+        """
+        Args:
+            nodes: names of live nodes
+            replicas: points of every node on the ring, more points spread
+            keys more evenly
+        """
+        self.ring = sorted((ring_hash(f'{node}#{replica}'), node)
+                           for node in set(nodes)
+                           for replica in range(replicas))
+        self.hashes = [point for point, _ in self.ring]
+
+    def owner(self, key: Hashable) -> str | None:
+        """Returns:
+            Node owning the key. None if there are no nodes.
+        """
+        if not self.ring:
+            return None
+        index = bisect(self.hashes, ring_hash(str(key))) % len(self.ring)
+        return self.ring[index][1]
@@ -0,0 +1,56 @@
+from typing import Awaitable, Callable, Dict
+
+import asyncio
+from redis.asyncio import Redis
+from redis.exceptions import RedisError, ResponseError
+
+BLOCK = 5000  # milliseconds to wait for new entries
+
+Entry = Dict[bytes, bytes]
+
+
+async def create_group(redis: Redis, stream: str, group: str, start: str):
+    try:
+        await redis.xgroup_create(stream, group, id=start, mkstream=True)
+    except ResponseError as error:
+        if 'BUSYGROUP' not in str(error):
+            raise
+
+
+async def read_group(redis: Redis, stream: str, group: str, consumer: str,
+                     handle: Callable[[Entry], Awaitable[None]],
+                     on_error: Callable[[BaseException], None],
+                     start: str = '$', count: int | None = None,
+                     block: int = BLOCK):
+    """Handles and acknowledges every entry of the stream read by consumer
+    of the group, until cancelled. Redis errors, including Redis down at
+    startup, are passed to on_error and retried after block. The group is
+    created again after an error, as it is gone if Redis has restarted
+    without data.
+    Args:
+        redis: client of the shared Redis
+        stream: key of the stream
+        group: consumer group, created if it doesn't exist
+        consumer: name of the reader in the group
+        handle: called with fields of every entry, must not raise
+        on_error: called with Redis error
+        start: id after which a new group reads entries, '$' for new ones
+        count: entries read at once
+        block: milliseconds to wait for new entries
+    """
+    group_created = False
+    while True:
+        try:
+            if not group_created:
+                await create_group(redis, stream, group, start)
+                group_created = True
+            response = await redis.xreadgroup(group, consumer, {stream: '>'},
+                                              count=count, block=block)
+            for _, messages in response:
+                for message_id, fields in messages:
+                    await handle(fields)
+                    await redis.xack(stream, group, message_id)
+        except RedisError as error:
+            on_error(error)
+            group_created = False
+            await asyncio.sleep(block / 1000)
@@ -0,0 +1,164 @@
+import time
+from typing import Awaitable, Callable, Dict, Tuple
+
+import asyncio
+import telegram.loggers as loggers
+from redis.exceptions import RedisError
+from telegram.supervisor import MAX_RESTARTS, RESTART_DELAY, TaskSupervisor
+from .jobs import COMMANDS, WORKERS_KEY, JobQueue, ScanResult, shard
+from .ring import HashRing
+
+HEARTBEAT = 5  # seconds between heartbeats and reconciliations
+WORKER_TTL = 15  # seconds without heartbeat when worker is considered dead
+DEBOUNCE = 0.5  # seconds to collect a burst of commands into one wakeup
+
+
+class Worker:
+    """Scans users claimed from the shared JobQueue.
+
+    Every worker sends heartbeats and owns the jobs which consistent hashing
+    assigns to it among live workers. Jobs are hashed by city, so users of
+    one city share polls, rate limits and circuit breaker of one worker. On every heartbeat and after every
+    command of front-end, the worker starts scans of its new jobs and stops
+    the scans which moved to another worker or were stopped. Jobs of a dead
+    worker move to the others after WORKER_TTL.
+
+    Crashed scan is restarted up to max_restarts times as in the bot
+    process. Then its job is dropped until front-end starts it again.
+    Finished scan is never restarted: its result is kept by the worker
+    and sent on every heartbeat until Redis takes it."""
+
+    def __init__(self, jobs: JobQueue, node: str,
+                 scan: Callable[[int], Awaitable[ScanResult]],
+                 on_failure: Callable[[int], Awaitable] | None = None,
+                 heartbeat: float = HEARTBEAT, ttl: float = WORKER_TTL,
+                 max_restarts: int = MAX_RESTARTS,
+                 restart_delay: float = RESTART_DELAY):
+        """
+        Args:
+            jobs: queue shared with front-end
+            node: name of the worker unique among all hosts
+            scan: scans user until result
+            on_failure: called with user id when job is dropped after
+                restarts
+            heartbeat: seconds between heartbeats
+            ttl: seconds without heartbeat when worker is considered dead
+            max_restarts: restarts of a crashed scan before giving up
+            restart_delay: seconds before restart of a crashed scan
+        """
+        self.jobs = jobs
+        self.redis = jobs.redis
+        self.node = node
+        self.scan = scan
+        self.on_failure = on_failure
+        self.heartbeat = heartbeat
+        self.ttl = ttl
+        # Start token of every owned job, given up ones too, by user id
+        self.tokens: Dict[int, str] = {}
+        # Start token and result of every finished scan not sent yet
+        self.finished: Dict[int, Tuple[str, ScanResult]] = {}
+        self._sending = asyncio.Lock()
+        self.supervisor = TaskSupervisor(self.run_job,
+                                         on_failure=self.give_up,
+                                         max_restarts=max_restarts,
+                                         restart_delay=restart_delay)
+
+    async def beat(self):
+        now = time.time()
+        await self.redis.zadd(WORKERS_KEY, {self.node: now})
+        await self.redis.zremrangebyscore(WORKERS_KEY, '-inf', now - self.ttl)
+
+    async def reconcile(self):
+        """Makes running scans match the jobs owned by this worker"""
+        ring = HashRing(node.decode() for node
+                        in await self.redis.zrange(WORKERS_KEY, 0, -1))
+        owned = {user_id: token
+                 for user_id, token in (await self.jobs.jobs()).items()
+                 if ring.owner(shard(user_id, token)) == self.node}
+        for user_id, token in tuple(self.tokens.items()):
+            if owned.get(user_id) != token:
+                self.supervisor.stop(user_id)
+                del self.tokens[user_id]
+                loggers.log(user_id, f'Released by worker {self.node}')
+        for user_id, token in owned.items():
+            # Restarted job has a new token and was released above. Finished
+            # scan only waits until its result is sent
+            if user_id in self.tokens or self.is_finished(user_id, token):
+                continue
+            self.tokens[user_id] = token
+            self.supervisor.start(user_id)
+            loggers.log(user_id, f'Claimed by worker {self.node}')
+
+    async def run_job(self, user_id: int):
+        token = self.tokens[user_id]
+        result = await self.scan(user_id)
+        # Result is kept outside the task, so failing to send it can't
+        # restart the scan, which may have booked already
+        self.finished[user_id] = (token, result)
+        await self.send_results()
+
+    def is_finished(self, user_id: int, token: str) -> bool:
+        finished = self.finished.get(user_id)
+        return finished is not None and finished[0] == token
+
+    async def send_results(self):
+        """Sends results of finished scans to front-end. Results are kept
+        on Redis errors and sent again on the next heartbeat"""
+        async with self._sending:
+            for user_id, (token, result) in tuple(self.finished.items()):
+                try:
+                    await self.jobs.finish(user_id, token, result)
+                except RedisError as error:
+                    loggers.log(user_id, str(error), loggers.ERROR)
+                    return
+                if self.is_finished(user_id, token):
+                    del self.finished[user_id]
+
+    async def give_up(self, user_id: int):
+        """Drops job of the scan which has crashed too many times"""
+        token = self.tokens.get(user_id)
+        if token is None:
+            return
+        try:
+            await self.jobs.drop(user_id, token)
+        except RedisError as error:
+            loggers.log(user_id, str(error), loggers.ERROR)
+        loggers.log(user_id, f'Dropped by worker {self.node}',
+                    loggers.WARNING)
+        if self.on_failure is not None:
+            await self.on_failure(user_id)
+
+    async def run(self):
+        """Serves jobs until cancelled"""
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(COMMANDS)
+        try:
+            while True:
+                try:
+                    await self.beat()
+                    await self.send_results()
+                    await self.reconcile()
+                    # Command of front-end wakes up the worker earlier
+                    command = await pubsub.get_message(
+                        ignore_subscribe_messages=True,
+                        timeout=self.heartbeat)
+                    if command is not None:
+                        await asyncio.sleep(DEBOUNCE)
+                        while command is not None:
+                            command = await pubsub.get_message(
+                                ignore_subscribe_messages=True)
+                except RedisError as error:
+                    loggers.log(0, str(error), loggers.ERROR)
+                    await asyncio.sleep(self.heartbeat)
+        finally:
+            await pubsub.unsubscribe(COMMANDS)
+            await pubsub.close()
+
+    async def close(self):
+        """Stops all scans and leaves the ring, so other workers take the
+        jobs over at once"""
+        await self.supervisor.close()
+        await self.send_results()
+        self.tokens.clear()
+        await self.redis.zrem(WORKERS_KEY, self.node)
+        await self.redis.publish(COMMANDS, f'leave {self.node}')
@@ -1,3 +1,4 @@
+from hashlib import sha256
 from os import environ
 
 # Any set of symbols for encrypting some database values
@@ -6,9 +7,33 @@ salt: str = environ['salt']
 
 # Both parameters should be 'localhost' for local usage
 # or 'redis' for docker usage
-redis_host: str = 'redis'
-bot_storage_host: str = 'redis'
+redis_host: str = environ.get('redis_host', 'redis')
+bot_storage_host: str = environ.get('bot_storage_host', 'redis')
+
+# Almaviva site. Benchmarks point it to a local fake server
+almaviva_url: str = environ.get('almaviva_url',
+                                'https://ru.almaviva-visa.services/')
+
+# 'local' to scan in the bot process, 'workers' to send scan jobs through
+# Redis to worker.py processes
+scan_mode: str = environ.get('scan_mode', 'local')
+
+# Local HTTP server with /metrics and /health
+metrics_host: str = environ.get('metrics_host', '127.0.0.1')
+metrics_port: int = int(environ.get('metrics_port', '8080'))
 
 # Telegram parameters
 admin_id: str = environ['admin_id']
 token: str = environ['token']
+
+# Public HTTPS address which Telegram sends updates to, e.g.
+# https://bot.example.com. Bot long-polls Telegram if it is empty. Webhook is
+# served by the server of metrics_host and metrics_port behind a proxy
+webhook_host: str = environ.get('webhook_host', '')
+webhook_path: str = environ.get('webhook_path', '/webhook')
+# Last part of the webhook path and secret token of Telegram requests. The
+# same for all replicas of the bot
+webhook_secret: str = environ.get('webhook_secret',
+                                  sha256(token.encode()).hexdigest())
+# Updates handled at once
+webhook_concurrency: int = int(environ.get('webhook_concurrency', '40'))
@@ -2,3 +2,4 @@ from .column_names import *
 from .sqlite import *
 from .table_names import *
 from .utils import *
+from . import aio
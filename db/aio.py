@@ -0,0 +1,252 @@
+"""Awaitable versions of db.sqlite functions. All queries go through one
+long-lived connection in WAL mode which lives in a dedicated thread, so
+database I/O never blocks the event loop."""
+import asyncio
+import sqlite3 as sq
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Set, Tuple
+
+import db
+import metrics
+import telegram.loggers as loggers
+from db import sqlite
+from .buffer import WriteBehindBuffer
+
+__all__ = [
+    'AsyncDatabase', 'database', 'write_buffer', 'flush_buffer',
+    'user_id_exists', 'check_data_acc',
+    'reset_values', 'select_data', 'delete_user', 'update_value',
+    'update_values', 'update_users', 'insert_row', 'select_active_users',
+    'get_ready_users'
+]
+
+
+QUERY_SECONDS = metrics.Histogram(
+    'sqlite_query_seconds', 'Time of SQLite queries in the database thread',
+    ('operation',))
+QUEUE_SECONDS = metrics.Histogram(
+    'sqlite_wait_seconds', 'Time of SQLite queries including the wait for '
+    'the database thread')
+
+
+def timed(func: Callable, *args) -> Tuple[Any, float]:
+    """Runs func in the database thread.
+    Returns:
+        Tuple(result, seconds of the run).
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+class AsyncDatabase:
+    """Runs queries one by one in a single worker thread, which owns the only
+    connection to the database"""
+
+    def __init__(self, path: str | None = None):
+        """
+        Args:
+            path: database file. db.sqlite.DB_PATH by default
+        """
+        self.path = path
+        self.writes = 0  # Rows passed to write queries since start
+        self._connection = None
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix='sqlite')
+
+    def _connect(self) -> sq.Connection:
+        """Opens connection on the first query. Runs in the worker thread"""
+        if self._connection is None:
+            self._connection = sq.connect(self.path or sqlite.DB_PATH,
+                                          check_same_thread=False)
+            # WAL doesn't work over network filesystems, so all processes
+            # using the file must run on its host
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+        return self._connection
+
+    async def _run(self, func: Callable, *args) -> Any:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        result, seconds = await loop.run_in_executor(self._executor, timed,
+                                                     func, *args)
+        # Metrics are updated in the event loop thread only
+        QUERY_SECONDS.observe(seconds, operation=func.__name__.lstrip('_'))
+        QUEUE_SECONDS.observe(loop.time() - start)
+        return result
+
+    def _execute(self, query: str, params: Iterable) -> None:
+        con = self._connect()
+        with con:
+            con.execute(query, params)
+        self.writes += 1
+
+    def _executemany(self, query: str, params: list[Iterable]) -> None:
+        con = self._connect()
+        with con:
+            con.executemany(query, params)
+        self.writes += len(params)
+
+    def _transaction(self, batches: list[Tuple[str, list]]) -> None:
+        con = self._connect()
+        with con:
+            for query, params in batches:
+                con.executemany(query, params)
+                self.writes += len(params)
+
+    def _fetchone(self, query: str, params: Iterable) -> Tuple | None:
+        return self._connect().execute(query, params).fetchone()
+
+    def _fetchall(self, query: str, params: Iterable) -> list[Tuple]:
+        return self._connect().execute(query, params).fetchall()
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    async def execute(self, query: str, params: Iterable = ()):
+        """Executes query in its own transaction"""
+        await self._run(self._execute, query, tuple(params))
+
+    async def executemany(self, query: str, params: Iterable[Iterable]):
+        """Executes query for every set of parameters in one transaction"""
+        await self._run(self._executemany, query, list(params))
+
+    async def transaction(self, batches: Iterable[Tuple[str, Iterable]]):
+        """Executes every query with its list of parameter sets in one
+        transaction"""
+        await self._run(self._transaction,
+                        [(query, list(params)) for query, params in batches])
+
+    async def fetchone(self, query: str, params: Iterable = ()
+                       ) -> Tuple | None:
+        return await self._run(self._fetchone, query, tuple(params))
+
+    async def fetchall(self, query: str, params: Iterable = ()
+                       ) -> list[Tuple]:
+        return await self._run(self._fetchall, query, tuple(params))
+
+    async def close(self):
+        """Closes connection. Next query opens a new one"""
+        await self._run(self._close)
+
+
+database = AsyncDatabase()
+# Scanner updates these columns on every request. They are kept in memory
+# and written in bulk by flush_buffer()
+write_buffer = WriteBehindBuffer((db.LAST_REQUEST, db.ATTEMPTS))
+FLUSH_INTERVAL = 10  # seconds
+
+
+async def flush_buffer():
+    """Writes all buffered values to account table in one transaction"""
+    drained = write_buffer.drain()
+    if not drained:
+        return
+    # Users with the same set of buffered columns share one query
+    batches = defaultdict(list)
+    for user_id, values in drained.items():
+        columns = tuple(sorted(values))
+        batches[columns].append(
+            tuple(values[column] for column in columns) + (user_id,))
+    queries = []
+    for columns, params in batches.items():
+        assignments = ', '.join(f'{column}=?' for column in columns)
+        queries.append((f'UPDATE {db.ACCOUNT} SET {assignments} '
+                        f'WHERE {db.USER_ID}=?', params))
+    try:
+        await database.transaction(queries)
+    except sq.Error:
+        write_buffer.restore(drained)
+        raise
+
+
+async def user_id_exists(user_id: int, table: str) -> bool:
+    query = f'SELECT * FROM {table} WHERE {db.USER_ID}=?'
+    loggers.log(user_id, query)
+    return await database.fetchone(query, (user_id,)) is not None
+
+
+async def insert_row(table: str, column: tuple | str,
+                     values: tuple | str | int):
+    if column:
+        column = f'({", ".join(column)})'
+    placeholders = ', '.join('?' * len(values))
+    query = f'INSERT INTO {table} {column} VALUES ({placeholders})'
+    await database.execute(query, values)
+
+
+async def update_value(user_id: int, table: str, column: str,
+                       value: str | int | None):
+    if table == db.ACCOUNT and write_buffer.accepts((column,)):
+        write_buffer.set(user_id, (column,), (value,))
+        return
+    query = (f'UPDATE {table} SET {column}=? '
+             f'WHERE {db.USER_ID}=?', (value, user_id))
+    loggers.log(user_id, str(query), loggers.DEBUG)
+    await database.execute(*query)
+
+
+async def update_values(user_id: int, table: str, columns: tuple[str, str],
+                        values: tuple[str | int | None, str | int | None]):
+    if table == db.ACCOUNT and write_buffer.accepts(columns):
+        write_buffer.set(user_id, columns, values)
+        return
+    query = (f'UPDATE {table} SET {columns[0]}=?, {columns[1]}=? '
+             f'WHERE {db.USER_ID}=?', (values[0], values[1], user_id))
+    loggers.log(user_id, str(query), loggers.DEBUG)
+    await database.execute(*query)
+
+
+async def update_users(user_ids: Iterable[int], table: str,
+                       columns: tuple[str, ...], values: tuple):
+    """Sets the same values to many users in one transaction"""
+    assignments = ', '.join(f'{column}=?' for column in columns)
+    query = f'UPDATE {table} SET {assignments} WHERE {db.USER_ID}=?'
+    await database.executemany(
+        query, [tuple(values) + (user_id,) for user_id in user_ids])
+
+
+async def delete_user(user_id: int):
+    write_buffer.discard(user_id)
+    for table in (db.ACCOUNT, db.SUCCESS):
+        query = f'DELETE FROM {table} WHERE {db.USER_ID}=?'
+        loggers.log(user_id, query, loggers.INFO)
+        await database.execute(query, (user_id,))
+
+
+async def select_data(user_id: int, table: str, column: str | int | tuple
+                      ) -> Tuple:
+    query = f'SELECT {column} FROM {table} WHERE {db.USER_ID}=?'
+    loggers.log(user_id, query)
+    row = await database.fetchone(query, (user_id,))
+    buffered = write_buffer.get(user_id) if table == db.ACCOUNT else None
+    if row is None or not buffered:
+        return row
+    # Newer values from write buffer replace the stored ones
+    columns = [name.strip() for name in str(column).split(',')]
+    return tuple(buffered.get(name, value)
+                 for name, value in zip(columns, row))
+
+
+async def select_active_users() -> list[Tuple[int]]:
+    query = f'SELECT {db.USER_ID} FROM {db.ACCOUNT} WHERE {db.IS_ACTIVE}=1'
+    return await database.fetchall(query)
+
+
+async def reset_values(table: str, column: str, value=False):
+    query = f'UPDATE {table} SET {column}=?'
+    await database.execute(query, (value,))
+
+
+async def check_data_acc() -> list[Tuple[int]]:
+    query = f'SELECT * FROM {db.ACCOUNT}'
+    return await database.fetchall(query)
+
+
+async def get_ready_users() -> Set[int]:
+    """Awaitable version of db.utils.get_ready_users"""
+    return db.filter_ready_users(await check_data_acc())
@@ -0,0 +1,49 @@
+from typing import Any, Dict, Iterable
+
+
+class WriteBehindBuffer:
+    """Keeps the latest values of frequently updated columns per user until
+    they are flushed to database. Repeated updates of the same user are
+    coalesced, so only the last value is written."""
+
+    def __init__(self, columns: Iterable[str]):
+        """
+        Args:
+            columns: columns that are buffered instead of written at once
+        """
+        self.columns = frozenset(columns)
+        self._pending: Dict[int, Dict[str, Any]] = {}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def accepts(self, columns: Iterable[str]) -> bool:
+        """Returns:
+            True if all columns are buffered.
+        """
+        return self.columns.issuperset(columns)
+
+    def set(self, user_id: int, columns: Iterable[str], values: Iterable):
+        self._pending.setdefault(user_id, {}).update(zip(columns, values))
+
+    def get(self, user_id: int) -> Dict[str, Any]:
+        """Returns:
+            Buffered values of user by column names or empty dict.
+        """
+        return self._pending.get(user_id, {})
+
+    def discard(self, user_id: int):
+        self._pending.pop(user_id, None)
+
+    def drain(self) -> Dict[int, Dict[str, Any]]:
+        """Takes all buffered values, leaving the buffer empty"""
+        pending, self._pending = self._pending, {}
+        return pending
+
+    def restore(self, drained: Dict[int, Dict[str, Any]]):
+        """Puts back values which were not flushed. Values updated after
+        drain() are newer and stay as they are."""
+        for user_id, values in drained.items():
+            pending = self._pending.setdefault(user_id, {})
+            for column, value in values.items():
+                pending.setdefault(column, value)
@@ -1,17 +1,25 @@
 from db.sqlite import check_data_acc
-from typing import Set
+from typing import Iterable, Set, Tuple
 
 
-def get_ready_users() -> Set[int]:
-    """Gets all user IDs with filled data, that are ready to run scanning.
+def filter_ready_users(rows: Iterable[Tuple]) -> Set[int]:
+    """Picks user IDs with filled data from rows of account table.
     Returns:
         Set of user IDs or empty set
     """
     ready_users = set()
-    for user in check_data_acc():
+    for user in rows:
         user_id_acc = user[0]
         # Check for blank fields in account table except columns:
         # start_time, is_active, last_request, attempts
         if None not in user[:9]:
             ready_users.add(user_id_acc)
     return ready_users
+
+
+def get_ready_users() -> Set[int]:
+    """Gets all user IDs with filled data, that are ready to run scanning.
+    Returns:
+        Set of user IDs or empty set
+    """
+    return filter_ready_users(check_data_acc())
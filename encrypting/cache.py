@@ -0,0 +1,65 @@
+import time
+from typing import Dict, List, Tuple
+
+import db
+from .encrypting import fernet
+
+CACHE_TTL = 900  # seconds
+
+
+class CredentialCache:
+    """Keeps decrypted account values in memory for ttl seconds. Repeated
+    scanner starts and re-authorizations skip database lookups and Fernet
+    decryption. Values are never logged and are dropped by invalidate()
+    as soon as the user changes or deletes the account."""
+
+    def __init__(self, ttl: float = CACHE_TTL):
+        self.ttl = ttl
+        # (user_id, column): (decrypted value, expiration time)
+        self._values: Dict[Tuple[int, str], Tuple[str, float]] = {}
+
+    async def get(self, user_id: int, *columns: str) -> List[str]:
+        """Returns:
+            Decrypted values of encrypted account columns in the same order.
+            Missing or expired values are read from database in one query.
+        """
+        now = time.monotonic()
+        values = {}
+        missing = []
+        for column in columns:
+            cached = self._values.get((user_id, column))
+            if cached is not None and cached[1] > now:
+                values[column] = cached[0]
+            else:
+                missing.append(column)
+
+        if missing:
+            row = await db.aio.select_data(user_id, db.ACCOUNT,
+                                           ', '.join(missing))
+            for column, data in zip(missing, row):
+                values[column] = fernet.decrypt(data).decode()
+                self.put(user_id, column, values[column])
+        return [values[column] for column in columns]
+
+    def put(self, user_id: int, column: str, value: str):
+        """Caches value which was just encrypted and saved to database"""
+        self._values[(user_id, column)] = (value, time.monotonic() + self.ttl)
+
+    def invalidate(self, user_id: int, *columns: str):
+        """Drops cached columns of user. All of them if columns are empty"""
+        if columns:
+            for column in columns:
+                self._values.pop((user_id, column), None)
+        else:
+            for key in [key for key in self._values if key[0] == user_id]:
+                del self._values[key]
+
+    def prune(self):
+        """Drops all expired values"""
+        now = time.monotonic()
+        for key in [key for key, (_, expires) in self._values.items()
+                    if expires <= now]:
+            del self._values[key]
+
+
+credentials = CredentialCache()
@@ -3,6 +3,7 @@ import base64
 from config import key, salt
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+from metrics import Timer
 
 
 def generate_key(key: str, salt: str) -> bytes:
@@ -11,4 +12,16 @@ def generate_key(key: str, salt: str) -> bytes:
     return base64.urlsafe_b64encode(derived_key)
 
 
-fernet = Fernet(generate_key(key, salt))
+class TimedFernet(Fernet):
+    """Fernet which measures time of encryption and decryption"""
+
+    @Timer('fernet.encrypt')
+    def encrypt(self, data: bytes) -> bytes:
+        return super().encrypt(data)
+
+    @Timer('fernet.decrypt')
+    def decrypt(self, token: bytes | str, ttl: int | None = None) -> bytes:
+        return super().decrypt(token, ttl)
+
+
+fernet = TimedFernet(generate_key(key, salt))
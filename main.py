@@ -1,21 +1,93 @@
 import asyncio
+import signal
+import cluster
+import config
 import db
+import metrics
+import scanner
 import telegram
+from aiogram import Dispatcher
 from aiogram.utils import executor
+from aiohttp import web
+
+# Runner of the HTTP server with metrics
+http_runner: web.AppRunner | None = None
+# Telegram updates in webhook mode
+webhook: telegram.WebhookHandler | None = None
+
+
+async def on_startup(dispatcher: Dispatcher):
+    global http_runner, webhook
+    telegram.bot.setup_jobs()
+    app = web.Application()
+    metrics.setup_routes(app)
+    if config.webhook_host:
+        webhook = telegram.WebhookHandler(dispatcher, config.webhook_secret,
+                                          config.webhook_concurrency)
+        telegram.webhook.setup_routes(app, webhook, config.webhook_path)
+    http_runner = await metrics.start_server(app, config.metrics_host,
+                                             config.metrics_port)
+    if webhook is not None:
+        # Telegram allows at most 100 connections
+        await dispatcher.bot.set_webhook(
+            f'{config.webhook_host.rstrip("/")}'
+            f'{config.webhook_path.rstrip("/")}/{config.webhook_secret}',
+            max_connections=min(config.webhook_concurrency, 100),
+            drop_pending_updates=True,
+            secret_token=config.webhook_secret
+        )
+    asyncio.create_task(metrics.monitor_loop_lag())
+    await scanner.startup()
+    if config.scan_mode == cluster.WORKERS:
+        # Send results of worker processes to users
+        asyncio.create_task(telegram.bot.read_results())
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    if http_runner is not None:
+        await http_runner.cleanup()
+    if webhook is not None:
+        await webhook.close()
+    await telegram.bot.supervisor.close()
+    await scanner.shutdown()
+
+
+def run_webhook(loop: asyncio.AbstractEventLoop):
+    """Receives updates by webhook on the server of metrics until SIGINT or
+    SIGTERM"""
+    dp = telegram.dp
+    loop.run_until_complete(on_startup(dp))
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(on_shutdown(dp))
+        loop.run_until_complete(dp.storage.close())
+        loop.run_until_complete(dp.storage.wait_closed())
+        session = loop.run_until_complete(dp.bot.get_session())
+        loop.run_until_complete(session.close())
 
 
 if __name__ == '__main__':
     # Create database and tables if they don't exist
     db.create_all_tables()
 
-    # Reset all users' scanning statuses to False
-    db.reset_values(db.ACCOUNT, db.IS_ACTIVE)
+    # Reset all users' scanning statuses to False. Jobs of worker processes
+    # survive restart of the bot
+    if config.scan_mode != cluster.WORKERS:
+        db.reset_values(db.ACCOUNT, db.IS_ACTIVE)
 
-    # Create schedule loop to restart all users' scanning
+    # Run scheduled jobs: daily restart of all users' scanning and
+    # maintenance
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     loop.create_task(telegram.run_schedule())
 
-    # Start bot with schedule loop
     telegram.dp.middleware.setup(telegram.ThrottlingMiddleware())
-    executor.start_polling(telegram.dp, loop=loop, skip_updates=True)
+    if config.webhook_host:
+        run_webhook(loop)
+    else:
+        # Start bot with schedule loop
+        executor.start_polling(telegram.dp, loop=loop, skip_updates=True,
+                               on_startup=on_startup, on_shutdown=on_shutdown)
@@ -0,0 +1,5 @@
+from .process import ASYNCIO_TASKS, LOOP_LAG, monitor_loop_lag
+from .registry import REGISTRY, Counter, Gauge, Histogram, Registry
+from .server import setup_routes, start_server
+from .profiling import STAGE_SECONDS, Timer, collapsed_stacks, \
+    sample_stacks, top_functions
@@ -0,0 +1,19 @@
+import time
+
+import asyncio
+from .registry import Gauge, Histogram
+
+LAG_INTERVAL = 0.5  # seconds between event loop lag measurements
+
+LOOP_LAG = Histogram('event_loop_lag_seconds',
+                     'Delay of a timer callback behind its due time')
+ASYNCIO_TASKS = Gauge('asyncio_tasks', 'Running asyncio tasks',
+                      func=lambda: len(asyncio.all_tasks()))
+
+
+async def monitor_loop_lag(interval: float = LAG_INTERVAL):
+    """Measures how late the event loop wakes up a sleeping coroutine"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, time.perf_counter() - start - interval))
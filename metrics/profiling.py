@@ -0,0 +1,113 @@
+import functools
+import inspect
+import sys
+import time
+from collections import Counter
+from types import FrameType
+from typing import Callable, Tuple
+
+from .registry import Histogram
+
+SAMPLE_INTERVAL = 0.005  # seconds between stack samples
+TOP = 25  # functions in the report
+
+STAGE_SECONDS = Histogram('stage_seconds', 'Time of instrumented stages',
+                          ('stage',))
+
+# Functions from the root of the stack to the sampled one
+Stack = Tuple[str, ...]
+
+
+class Timer:
+    """Measures time of a stage into STAGE_SECONDS. Works as a context
+    manager:
+
+        with Timer('fernet.decrypt'):
+            ...
+
+    and as a decorator of functions and coroutine functions:
+
+        @Timer('scanner.find_free_day')
+        async def find_free_day(...):
+    """
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.start = 0.0
+
+    def __enter__(self) -> 'Timer':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        STAGE_SECONDS.observe(time.perf_counter() - self.start,
+                              stage=self.stage)
+
+    def __call__(self, func: Callable) -> Callable:
+        stage = self.stage
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def timed(*args, **kwargs):
+                with Timer(stage):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def timed(*args, **kwargs):
+                with Timer(stage):
+                    return func(*args, **kwargs)
+        return timed
+
+
+def frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})'
+
+
+def sample_stacks(thread_id: int, seconds: float,
+                  interval: float = SAMPLE_INTERVAL) -> Counter:
+    """Samples stack of the thread from another thread. Blocks for seconds,
+    so it runs in executor.
+    Returns:
+        Number of samples of every stack.
+    """
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(frame_name(frame))
+            frame = frame.f_back
+        if stack:
+            stacks[tuple(reversed(stack))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def top_functions(stacks: Counter, limit: int = TOP) -> str:
+    """Returns:
+        Functions with the most samples on top of the stack (self) and
+        anywhere in the stack (total).
+    """
+    samples = sum(stacks.values())
+    if not samples:
+        return 'No samples'
+    own = Counter()
+    total = Counter()
+    for stack, count in stacks.items():
+        own[stack[-1]] += count
+        for name in set(stack):
+            total[name] += count
+    lines = [f'Samples: {samples}', 'self% total% function']
+    for name, count in own.most_common(limit):
+        lines.append(f'{100 * count / samples:5.1f} '
+                     f'{100 * total[name] / samples:5.1f} {name}')
+    return '\n'.join(lines)
+
+
+def collapsed_stacks(stacks: Counter) -> str:
+    """Returns:
+        Stacks in collapsed format of flamegraph.pl and speedscope.
+    """
+    return '\n'.join(f'{";".join(stack)} {count}'
+                     for stack, count in stacks.most_common()) + '\n'
@@ -0,0 +1,152 @@
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# Label values of one series in the order of metric label names
+LabelValues = Tuple[str, ...]
+
+# Seconds. Fits everything from a cached SQLite read to a slow booking
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+           30, 60, 300)
+
+
+def format_labels(names: Tuple[str, ...], values: LabelValues,
+                  extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    """Named family of series, one series for every set of label values"""
+    kind = ''
+
+    def __init__(self, name: str, description: str,
+                 labels: Iterable[str] = (), registry=None):
+        """
+        Args:
+            name: metric name in Prometheus format
+            description: help text
+            labels: names of labels every observation has
+            registry: REGISTRY by default
+        """
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def key(self, labels: Dict[str, object]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.description}',
+                 f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """Value which only grows"""
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, value: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def get(self, **labels) -> float:
+        return self.values.get(self.key(labels), 0)
+
+    def samples(self) -> Iterable[str]:
+        for key, value in self.values.items():
+            yield f'{self.name}{format_labels(self.label_names, key)} {value}'
+
+
+class Gauge(Metric):
+    """Value which goes up and down. Value of a gauge with function is read
+    at the moment of rendering"""
+    kind = 'gauge'
+
+    def __init__(self, *args, func: Callable[[], float] | None = None,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.func = func
+        self.values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels):
+        self.values[self.key(labels)] = value
+
+    def get(self, **labels) -> float:
+        if self.func is not None:
+            return self.func()
+        return self.values.get(self.key(labels), 0)
+
+    def samples(self) -> Iterable[str]:
+        if self.func is not None:
+            yield f'{self.name} {self.func()}'
+            return
+        for key, value in self.values.items():
+            yield f'{self.name}{format_labels(self.label_names, key)} {value}'
+
+
+class Histogram(Metric):
+    """Distribution of observed values over cumulative buckets"""
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets: Iterable[float] = BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # Label values: (count in every bucket and above all, sum)
+        self.values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1][0] += value
+
+    def count(self, **labels) -> int:
+        series = self.values.get(self.key(labels))
+        return sum(series[0]) if series else 0
+
+    def samples(self) -> Iterable[str]:
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = format_labels(self.label_names, key,
+                                       f'le="{bound}"')
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = format_labels(self.label_names, key)
+            yield f'{self.name}_sum{labels} {total[0]}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class Registry:
+    """All metrics of the process"""
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self.metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """Returns:
+            All metrics in Prometheus text format.
+        """
+        return '\n'.join(metric.render()
+                         for metric in self.metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
@@ -0,0 +1,33 @@
+import time
+
+from aiohttp import web
+from .registry import REGISTRY, Registry
+
+START_TIME = time.time()
+
+
+def setup_routes(app: web.Application, registry: Registry = REGISTRY):
+    """Adds /metrics and /health to app, so any aiohttp app of the process
+    can serve them"""
+
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type='text/plain')
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({'status': 'ok',
+                                  'uptime': round(time.time() - START_TIME)})
+
+    app.router.add_get('/metrics', metrics)
+    app.router.add_get('/health', health)
+
+
+async def start_server(app: web.Application, host: str,
+                       port: int) -> web.AppRunner:
+    """Serves app on host and port in the running event loop.
+    Returns:
+        Runner to clean up on shutdown.
+    """
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
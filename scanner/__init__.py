@@ -1,2 +1,3 @@
-from .scanner import Appointment, run_auth, YEAR, MOSCOW_TZ
+from .scanner import Appointment, run_auth, YEAR, MOSCOW_TZ, HTTP, \
+    REDIS_CLIENT, CADENCE, SNAPSHOTS, EVENTS, AUTH, startup, shutdown
 from .templates.ru import *
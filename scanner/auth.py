@@ -0,0 +1,136 @@
+import time
+from base64 import urlsafe_b64decode
+from typing import Awaitable, Callable, Dict, Set
+
+import asyncio
+import telegram.loggers as loggers
+from orjson import loads
+
+TOKEN_TTL = 3600  # seconds of token life if it doesn't tell its expiry
+REFRESH_MARGIN = 300  # seconds before expiry when token is refreshed
+MAX_LOGINS = 4  # background logins running at once
+LOGIN_BACKOFF = 60  # seconds before the first retry of a failed refresh
+MAX_LOGIN_BACKOFF = 1800  # the longest pause between failed refreshes
+
+
+class Unauthorized(Exception):
+    """Upstream rejected auth token of the user"""
+
+    def __init__(self, user_id: int):
+        super().__init__(f'Unauthorized {user_id}')
+        self.user_id = user_id
+
+
+def token_expiry(token: str) -> float | None:
+    """Returns:
+        Unix time from 'exp' claim of JWT token. None if token is not JWT
+        or has no expiry.
+    """
+    try:
+        payload = token.split('.')[1]
+        claims = loads(urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return float(claims['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class AuthManager:
+    """Tracks expiry of auth tokens of scanning users and logs them in again
+    ahead of time, a few users at once. Fresh token goes straight to the
+    running appointments of its user, so they keep scanning without
+    restart."""
+
+    def __init__(self, login: Callable[[int], Awaitable],
+                 ttl: float = TOKEN_TTL, margin: float = REFRESH_MARGIN,
+                 max_logins: int = MAX_LOGINS):
+        """
+        Args:
+            login: logs user in, calls update() with the new token and
+                returns the response of login api
+            ttl: seconds of token life if it doesn't tell its expiry
+            margin: seconds before expiry when token is refreshed
+            max_logins: background logins running at once
+        """
+        self.login = login
+        self.ttl = ttl
+        self.margin = margin
+        self.expires: Dict[int, float] = {}
+        # Running appointments of every user. Each has set_token()
+        self.watchers: Dict[int, Set] = {}
+        # Failed refreshes in a row of every scanning user
+        self.failures: Dict[int, int] = {}
+        self._logins: Dict[int, asyncio.Task] = {}
+        self._semaphore = asyncio.Semaphore(max_logins)
+
+    def update(self, user_id: int, token: str):
+        """Records a new token of the user and hands it to the user's
+        appointments. Expiry is tracked only while the user is scanning"""
+        if user_id in self.watchers:
+            self.expires[user_id] = token_expiry(token) \
+                                    or time.time() + self.ttl
+            self.failures.pop(user_id, None)
+        for appointment in tuple(self.watchers.get(user_id, ())):
+            appointment.set_token(token)
+
+    def watch(self, appointment):
+        """Keeps token of the appointment fresh while it is scanning"""
+        self.watchers.setdefault(appointment.user_id, set()).add(appointment)
+        if appointment.user_id not in self.expires:
+            # Age of a token from database is unknown without expiry claim
+            self.expires[appointment.user_id] = \
+                token_expiry(appointment.auth_token) \
+                or time.time() + self.ttl
+
+    def unwatch(self, appointment):
+        watchers = self.watchers.get(appointment.user_id)
+        if watchers is not None:
+            watchers.discard(appointment)
+            if not watchers:
+                del self.watchers[appointment.user_id]
+                self.expires.pop(appointment.user_id, None)
+                self.failures.pop(appointment.user_id, None)
+
+    async def refresh(self, user_id: int):
+        """Logs user in again. Concurrent refreshes of the same user share
+        one login. Scanning user whose login has failed is not logged in
+        again until the backoff ends"""
+        if self.failures.get(user_id) \
+                and self.expires.get(user_id, 0) > time.time() + self.margin:
+            return
+        task = self._logins.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self._login(user_id))
+            self._logins[user_id] = task
+            task.add_done_callback(lambda _: self._logins.pop(user_id, None))
+        await asyncio.shield(task)
+
+    async def _login(self, user_id: int):
+        async with self._semaphore:
+            try:
+                response = await self.login(user_id)
+            except Exception as error:
+                self.back_off(user_id, repr(error))
+                raise
+        if response.status != 200:
+            self.back_off(user_id, f'status {response.status}')
+
+    def back_off(self, user_id: int, reason: str):
+        """Puts off the next refresh of a scanning user after failed login,
+        twice as long after every failure in a row"""
+        loggers.log(user_id, f'Token refresh failed: {reason}',
+                    loggers.WARNING)
+        if user_id not in self.watchers:
+            return
+        failures = self.failures.get(user_id, 0)
+        self.failures[user_id] = failures + 1
+        delay = min(MAX_LOGIN_BACKOFF, LOGIN_BACKOFF * 2 ** failures)
+        self.expires[user_id] = time.time() + self.margin + delay
+
+    async def refresh_expiring(self):
+        """Refreshes tokens of scanning users which expire soon"""
+        deadline = time.time() + self.margin
+        expiring = [user_id for user_id in self.watchers
+                    if self.expires.get(user_id, 0) <= deadline]
+        # Failures are logged and backed off by _login()
+        await asyncio.gather(*(self.refresh(user_id) for user_id in expiring),
+                             return_exceptions=True)
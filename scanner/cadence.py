@@ -0,0 +1,157 @@
+import time
+from datetime import date, datetime, tzinfo
+from typing import Dict, Iterable, List
+
+import db
+from .snapshots import APPEARED, Key, SnapshotStore
+
+HOT_WINDOW = 3600  # seconds since the last free slot when the key is hot
+# Hits which every hour is assumed to have as many as expected. Keeps hour
+# factors near 1 until hours have a few hits
+PRIOR_HITS = 5
+MIN_FACTOR = 0.25
+MAX_FACTOR = 4
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri')
+
+
+def clamp(value: float, low: float, high: float) -> float:
+    return max(low, min(high, value))
+
+
+class CadenceModel:
+    """Learns when free slots appear and turns it into factors of poll
+    intervals: below 1 for hot keys, hours and weekdays, above 1 for cold
+    ones.
+
+    Sources:
+        success table - weekdays of booked appointment dates.
+        Bookings of other bot processes - weekdays of booked dates.
+        Snapshot history - weekdays of dates and hours of the day when free
+        slots appeared and keys which had free slots recently, kept between
+        restarts.
+        Poll results - hours of the day (Moscow) when free slots appear
+        and keys which had new free slots recently.
+    """
+
+    def __init__(self, tz: tzinfo, year: int,
+                 snapshots: SnapshotStore | None = None):
+        """
+        Args:
+            tz: timezone of the hour of the day
+            year: year of all scanned dates
+            snapshots: store with history of slot changes
+        """
+        self.tz = tz
+        self.year = year
+        self.snapshots = snapshots
+        self.hour_polls = [0] * 24
+        self.hour_hits = [0] * 24
+        # Polls with appeared free slots from snapshot history. Their polls
+        # are unknown, so every hour is assumed to be polled the same
+        self.history_hits = [0] * 24
+        self.weekday_hits = [0] * len(WEEKDAYS)
+        self.last_seen: Dict[Key, float] = {}
+
+    async def load(self):
+        """Counts weekdays of successful appointments and of appeared free
+        slots, restores hot keys"""
+        rows = await db.aio.database.fetchall(
+            f'SELECT {db.SUCCESS_MONTH}, {db.SUCCESS_DAY} FROM {db.SUCCESS}')
+        if self.snapshots is not None:
+            polls = set()
+            # History is the newest first
+            for event in reversed(await self.snapshots.history()):
+                if event.kind != APPEARED:
+                    continue
+                _, month, day = event.key
+                rows.append((int(month), int(day)))
+                self.last_seen[event.key] = \
+                    time.monotonic() - (time.time() - event.fetched)
+                polls.add((event.key, event.fetched))
+            # One hit per poll, as in observe()
+            for _, fetched in polls:
+                self.history_hits[
+                    datetime.fromtimestamp(fetched, self.tz).hour] += 1
+        for month, day in rows:
+            weekday = date(self.year, month, day).weekday()
+            if weekday < len(WEEKDAYS):
+                self.weekday_hits[weekday] += 1
+
+    def observe(self, key: Key, slots: Iterable):
+        """Records result of one poll of the key. Slots are the ones
+        appeared since the previous poll, so a slot which stays listed is
+        counted once"""
+        hour = datetime.now(self.tz).hour
+        self.hour_polls[hour] += 1
+        if not slots:
+            return
+        self.hour_hits[hour] += 1
+        self.last_seen[key] = time.monotonic()
+        _, month, day = key
+        weekday = date(self.year, int(month), int(day)).weekday()
+        if weekday < len(WEEKDAYS):
+            self.weekday_hits[weekday] += 1
+
+    async def on_booked(self, data: Dict):
+        """Counts appointment booked by another bot process"""
+        weekday = date(self.year, int(data['month']),
+                       int(data['day'])).weekday()
+        if weekday < len(WEEKDAYS):
+            self.weekday_hits[weekday] += 1
+
+    def hour_factors(self) -> List[float]:
+        """Compares hits of every hour with hits expected if free slots were
+        seen at the same rate all day. Live hits are expected in proportion
+        to polls of the hour, hits from history evenly. Hours without data
+        have factor 1 whatever the overall hit rate is"""
+        polls = sum(self.hour_polls)
+        live_hits = sum(self.hour_hits)
+        history_hits = sum(self.history_hits)
+        factors = []
+        for hour in range(24):
+            expected = history_hits / 24
+            if polls:
+                expected += live_hits * self.hour_polls[hour] / polls
+            observed = self.hour_hits[hour] + self.history_hits[hour]
+            factors.append(clamp((expected + PRIOR_HITS)
+                                 / (observed + PRIOR_HITS), 0.5, 2))
+        return factors
+
+    def weekday_factors(self) -> List[float]:
+        mean = sum(self.weekday_hits) / len(self.weekday_hits)
+        return [clamp((mean + 1) / (hits + 1), 0.5, 2)
+                for hits in self.weekday_hits]
+
+    def is_hot(self, key: Key) -> bool:
+        last_seen = self.last_seen.get(key)
+        return last_seen is not None and \
+            time.monotonic() - last_seen < HOT_WINDOW
+
+    def factor(self, key: Key) -> float:
+        """Returns:
+            Multiplier of the key poll interval.
+        """
+        _, month, day = key
+        factor = self.hour_factors()[datetime.now(self.tz).hour]
+        weekday = date(self.year, int(month), int(day)).weekday()
+        if weekday < len(WEEKDAYS):
+            factor *= self.weekday_factors()[weekday]
+        if self.is_hot(key):
+            factor *= 0.5
+        return clamp(factor, MIN_FACTOR, MAX_FACTOR)
+
+    def report(self) -> str:
+        """Returns:
+            Human-readable state of the model for admin.
+        """
+        hours = ' '.join(f'{hour:02}:{factor:.2f}' for hour, factor
+                         in enumerate(self.hour_factors()))
+        weekdays = ' '.join(f'{name}:{factor:.2f}' for name, factor
+                            in zip(WEEKDAYS, self.weekday_factors()))
+        hot = sum(self.is_hot(key) for key in self.last_seen)
+        return (f'Hour factors: {hours}\n'
+                f'Weekday factors: {weekdays}\n'
+                f'Hot keys: {hot}\n'
+                f'Polls: {sum(self.hour_polls)}, '
+                f'with free slots: {sum(self.hour_hits)}, '
+                f'from history: {sum(self.history_hits)}')
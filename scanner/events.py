@@ -0,0 +1,101 @@
+import os
+import socket
+from typing import Awaitable, Callable, Dict, List
+
+import asyncio
+import telegram.loggers as loggers
+from cluster.streams import read_group
+from orjson import dumps, loads
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+# Kinds of events
+SLOTS_SEEN = 'slots-seen'
+BOOKED = 'booked'
+STREAM = 'events'
+MAX_LEN = 10000  # about the latest events kept in the stream
+BATCH = 100  # events read at once
+
+Handler = Callable[[Dict], Awaitable[None]]
+
+
+def node_id() -> str:
+    """Returns:
+        Name of this bot process unique among all hosts.
+    """
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class EventBus:
+    """Redis Streams bus between bot processes sharing one Redis. Every
+    process reads the whole stream with its own consumer group and skips
+    events it has published itself."""
+
+    def __init__(self, redis: Redis, stream: str = STREAM,
+                 node: str | None = None, max_len: int = MAX_LEN):
+        """
+        Args:
+            redis: client of the shared Redis
+            stream: key of the stream
+            node: name of this process, also name of its consumer group
+            max_len: approximate number of events kept in the stream
+        """
+        self.redis = redis
+        self.stream = stream
+        self.node = node or node_id()
+        self.max_len = max_len
+        self.handlers: Dict[str, List[Handler]] = {}
+        self._reader: asyncio.Task | None = None
+
+    def subscribe(self, kind: str, handler: Handler):
+        """Calls handler with data of every event of the kind published by
+        other processes"""
+        self.handlers.setdefault(kind, []).append(handler)
+
+    async def publish(self, kind: str, data: Dict):
+        await self.redis.xadd(
+            self.stream,
+            {'node': self.node, 'kind': kind, 'data': dumps(data)},
+            maxlen=self.max_len,
+            approximate=True
+        )
+
+    def start(self):
+        """Starts reading events in background"""
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.create_task(self.run())
+
+    async def run(self):
+        """Reads events until cancelled. Only events published after the
+        start are read"""
+        await read_group(
+            self.redis, self.stream, self.node, self.node, self.dispatch,
+            lambda error: loggers.log(0, str(error), loggers.ERROR),
+            count=BATCH)
+
+    async def dispatch(self, fields: Dict[bytes, bytes]):
+        try:
+            node = fields[b'node'].decode()
+            kind = fields[b'kind'].decode()
+            data = loads(fields[b'data'])
+        except (KeyError, UnicodeDecodeError, ValueError) as error:
+            loggers.log(0, f'Malformed event {fields!r}: {error!r}',
+                        loggers.ERROR)
+            return
+        if node == self.node:
+            return
+        for handler in self.handlers.get(kind, ()):
+            try:
+                await handler(data)
+            except Exception as error:
+                loggers.log(0, str(error), loggers.ERROR)
+
+    async def close(self):
+        """Stops reading and removes consumer group of this process"""
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+        try:
+            await self.redis.xgroup_destroy(self.stream, self.node)
+        except RedisError:
+            pass
@@ -0,0 +1,256 @@
+import heapq
+import time
+from random import sample, uniform
+from typing import Dict, List, Tuple
+
+import asyncio
+import telegram.loggers as loggers
+from redis.exceptions import RedisError
+from .auth import Unauthorized
+from .cadence import CadenceModel
+from .events import SLOTS_SEEN, EventBus
+from .responses import Slot
+from .snapshots import APPEARED, Key, SnapshotStore
+
+AUTH_ATTEMPTS = 3  # users tried by one poll when tokens are rejected
+
+
+class SlotPoller:
+    """Polls every (siteId, date) key once and fans the free slots out to
+    all appointments subscribed to that key. Users watching the same
+    city and dates share a single upstream request.
+
+    Keys wait in a heap ordered by the time of their next poll, so keys with
+    higher weight (nearest dates) and hot keys are revisited more often
+    instead of waiting for a full sweep of all dates.
+
+    Every poll result is stored in the snapshot store. Subscribers get all
+    free slots after every poll, appeared ones first. Appeared slots are
+    published to other bot processes, and slots they have seen are
+    delivered here the same way. Key which another process has polled
+    within the interval is not polled again: its snapshot is delivered
+    instead.
+    """
+
+    def __init__(self, cadence: CadenceModel, snapshots: SnapshotStore,
+                 events: EventBus, pause: Tuple[float, float] = (5, 10)):
+        """
+        Args:
+            cadence: model which makes hot keys polled more often
+            snapshots: shared store of the last slot lists
+            events: bus between bot processes
+            pause: bounds of random pause in seconds between two requests of
+            a single user sweep
+        """
+        self.cadence = cadence
+        self.snapshots = snapshots
+        self.events = events
+        self.pause = pause
+        # Subscribers of the key and versions of snapshot they have seen
+        self.subscribers: Dict[Key, Dict[object, int]] = {}
+        # (due time, key) of every scheduled poll. Outdated entries are
+        # skipped when popped
+        self.queue: List[Tuple[float, Key]] = []
+        self.due: Dict[Key, float] = {}
+        self.polls: Dict[Key, asyncio.Task] = {}
+        # Unix time when own poll of the key was stored
+        self.polled: Dict[Key, float] = {}
+        self._scheduler: asyncio.Task | None = None
+        self._wakeup = asyncio.Event()
+
+    def subscribe(self, appointment, month: str, day: str):
+        """Adds appointment to the key subscribers and schedules the key if
+        it is new"""
+        key = (appointment.site_id, month, day)
+        self.subscribers.setdefault(key, {})[appointment] = 0
+        if key not in self.due and key not in self.polls:
+            # Spread first requests of all keys over the whole sweep
+            self.schedule(key, uniform(0, self.interval(key)))
+        if self._scheduler is None or self._scheduler.done():
+            self._scheduler = asyncio.create_task(self.run())
+
+    def unsubscribe(self, appointment, month: str, day: str):
+        """Removes appointment from the key subscribers. Forgets the key when
+        nobody is subscribed anymore"""
+        key = (appointment.site_id, month, day)
+        subscribers = self.subscribers.get(key)
+        if subscribers is not None:
+            subscribers.pop(appointment, None)
+        if not subscribers:
+            self.subscribers.pop(key, None)
+            self.due.pop(key, None)
+            self.polled.pop(key, None)
+            poll = self.polls.pop(key, None)
+            if poll is not None:
+                poll.cancel()
+
+    def interval(self, key: Key) -> float:
+        """Returns:
+            Pause in seconds before the next poll of the key. A subscriber
+            sweeps all its dates as often as before, but every date gets a
+            share of the sweep proportional to its weight. The key follows
+            its most demanding subscriber. Cadence model shortens pauses of
+            hot keys and stretches cold ones.
+        """
+        _, month, day = key
+        sweep = min(
+            appointment.total_weight / appointment.weights[(month, day)]
+            for appointment in self.subscribers[key]
+        )
+        return uniform(*self.pause) * sweep * self.cadence.factor(key)
+
+    def schedule(self, key: Key, delay: float):
+        due = asyncio.get_running_loop().time() + delay
+        self.due[key] = due
+        heapq.heappush(self.queue, (due, key))
+        # Scheduler may sleep until a later key
+        if self.queue[0][1] == key:
+            self._wakeup.set()
+
+    async def run(self):
+        """Starts polls of the keys in order of their due time"""
+        loop = asyncio.get_running_loop()
+        while self.subscribers:
+            self._wakeup.clear()
+            if not self.queue:
+                await self._wakeup.wait()
+                continue
+            due, key = self.queue[0]
+            if self.due.get(key) != due:
+                heapq.heappop(self.queue)
+                continue
+            if due > loop.time():
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(),
+                                           due - loop.time())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self.queue)
+            del self.due[key]
+            self.polls[key] = asyncio.create_task(self.poll(key))
+
+    async def reuse(self, key: Key) -> bool:
+        """Delivers snapshot of the key which another process has stored
+        within the poll interval and schedules the next poll after the
+        interval since that snapshot.
+        Returns:
+            True if the snapshot is delivered instead of polling.
+        """
+        try:
+            snapshot = await self.snapshots.get(key)
+        except RedisError as error:
+            loggers.log(0, str(error), loggers.ERROR)
+            return False
+        if snapshot is None or snapshot.fetched <= self.polled.get(key, 0):
+            return False
+        interval = self.interval(key)
+        age = time.time() - snapshot.fetched
+        if age >= interval:
+            return False
+        # Its appeared slots have come by the event bus already
+        self.deliver(key, snapshot.slots, snapshot.version, [])
+        self.schedule(key, interval - age)
+        return True
+
+    async def poll(self, key: Key):
+        """Fetches slots for the key once and schedules the next poll"""
+        _, month, day = key
+        # Any subscriber's auth token is suitable to read slots. Rejected
+        # token is replaced by the token of another user
+        subscribers = tuple(self.subscribers[key])
+        users = set()
+        slots = None
+        try:
+            if await self.reuse(key):
+                return
+            for appointment in sample(subscribers, len(subscribers)):
+                if appointment.user_id in users:
+                    continue
+                users.add(appointment.user_id)
+                try:
+                    slots = await appointment.find_free_day(month, day)
+                except Unauthorized:
+                    if len(users) < AUTH_ATTEMPTS:
+                        continue
+                    loggers.log(appointment.user_id, f'{key} is not polled:'
+                                f' tokens are rejected', loggers.WARNING)
+                except Exception as error:
+                    loggers.log(appointment.user_id, str(error),
+                                loggers.ERROR)
+                break
+        finally:
+            if self.polls.get(key) is asyncio.current_task():
+                del self.polls[key]
+
+        if slots is not None:
+            try:
+                version, events = await self.snapshots.update(key, slots)
+                self.polled[key] = time.time()
+            except RedisError as error:
+                loggers.log(appointment.user_id, str(error), loggers.ERROR)
+                # Without the store everybody gets the whole list
+                version, events = None, []
+            appeared = [Slot(event.time, event.free_spots)
+                        for event in events if event.kind == APPEARED]
+            # Slots which stay listed are not news, so only appeared ones
+            # make the key hot
+            self.cadence.observe(key, appeared)
+            self.deliver(key, slots, version, appeared)
+            if appeared:
+                await self.publish(key, version, appeared)
+        if self.subscribers.get(key):
+            self.schedule(key, self.interval(key))
+
+    def deliver(self, key: Key, slots: List[Slot], version: int | None,
+                appeared: List[Slot], polled: bool = True):
+        """Puts free slots to inbox of every subscriber, appeared ones first
+        to be claimed first. After own poll every subscriber gets all slots
+        still listed, even without news: a slot which failed validation is
+        offered again, and Redis claim of validate lets somebody retry it
+        when the claim expires. Claims of cancelled validations are released
+        at once. Slots of another process are skipped by subscribers which
+        have seen their snapshot."""
+        _, month, day = key
+        appeared_times = {slot.time for slot in appeared}
+        news = appeared + [slot for slot in slots
+                           if slot.time not in appeared_times]
+        subscribers = self.subscribers.get(key, {})
+        for subscriber, seen in tuple(subscribers.items()):
+            if not polled and version is not None and seen >= version:
+                continue
+            subscriber.inbox.put_nowait((month, day, news))
+            if version is not None:
+                subscribers[subscriber] = max(seen, version)
+
+    async def publish(self, key: Key, version: int, appeared: List[Slot]):
+        site_id, month, day = key
+        try:
+            await self.events.publish(SLOTS_SEEN, {
+                'site_id': site_id,
+                'month': month,
+                'day': day,
+                'version': version,
+                'slots': [(slot.time, slot.free_spots) for slot in appeared]
+            })
+        except RedisError as error:
+            loggers.log(0, str(error), loggers.ERROR)
+
+    async def on_slots_seen(self, data: Dict):
+        """Delivers slots appeared in a poll of another bot process"""
+        key = (data['site_id'], data['month'], data['day'])
+        if not self.subscribers.get(key):
+            return
+        appeared = [Slot(time, free_spots) for time, free_spots
+                    in data['slots']]
+        self.cadence.observe(key, appeared)
+        version, slots = data['version'], appeared
+        if any(seen < version - 1
+               for seen in self.subscribers[key].values()):
+            # Somebody missed earlier changes and needs the whole list
+            snapshot = await self.snapshots.get(key)
+            if snapshot is not None and snapshot.version >= version:
+                if snapshot.version > version:
+                    appeared = snapshot.slots
+                version, slots = snapshot.version, snapshot.slots
+        self.deliver(key, slots, version, appeared, polled=False)
@@ -0,0 +1,66 @@
+import time
+from typing import Dict, Hashable, Tuple
+
+import asyncio
+
+# (requests per second, burst size)
+Limit = Tuple[float, float]
+
+
+class TokenBucket:
+    """Gives out rate tokens per second, up to capacity tokens at once.
+    Waiting coroutines are served in the order they came."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """Waits until a token is available and takes it"""
+        # Lock queues waiters fairly, so busy users can't starve the rest
+        async with self._lock:
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+class RateLimiter:
+    """Token buckets shared by all users. Every request waits for a token of
+    its site (if the endpoint is limited per site) and of its endpoint, so
+    total request rate stays under a fixed ceiling whatever the number of
+    users is."""
+
+    def __init__(self, limits: Dict[str, Limit],
+                 site_limits: Dict[str, Limit] | None = None):
+        """
+        Args:
+            limits: limit of every endpoint for all sites together
+            site_limits: limit of endpoint for every single site
+        """
+        self.limits = limits
+        self.site_limits = site_limits or {}
+        self.buckets: Dict[Hashable, TokenBucket] = {}
+
+    def bucket(self, key: Hashable, limit: Limit) -> TokenBucket:
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(*limit)
+        return self.buckets[key]
+
+    async def acquire(self, endpoint: str, site_id: int | None = None):
+        """Waits for permission to make one request to endpoint"""
+        if site_id is not None and endpoint in self.site_limits:
+            await self.bucket((endpoint, site_id),
+                              self.site_limits[endpoint]).acquire()
+        if endpoint in self.limits:
+            await self.bucket(endpoint, self.limits[endpoint]).acquire()
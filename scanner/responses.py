@@ -0,0 +1,31 @@
+import re
+from typing import List
+
+from orjson import loads
+
+# Any time interval with at least one free spot
+FREE_SPOTS = re.compile(rb'"freeSpots"\s*:\s*[1-9]')
+
+
+class Slot:
+    """Time interval of appointment-slots response"""
+    __slots__ = ('time', 'free_spots')
+
+    def __init__(self, time: str, free_spots: int):
+        self.time = time
+        self.free_spots = free_spots
+
+    def __repr__(self) -> str:
+        return f'Slot({self.time!r}, {self.free_spots})'
+
+
+def free_slots(body: bytes) -> List[Slot]:
+    """Decodes appointment-slots response body read once into memory.
+    Returns:
+        Time intervals with free spots. Nearly every response has none, so
+        the body is decoded only if the raw bytes contain a free spot.
+    """
+    if not FREE_SPOTS.search(body):
+        return []
+    return [Slot(line['time'], line['freeSpots'])
+            for line in loads(body) if line and line['freeSpots']]
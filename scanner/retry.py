@@ -0,0 +1,175 @@
+import time
+from random import uniform
+from typing import Awaitable, Callable, Dict, Tuple, Type, TypeVar
+
+import asyncio
+import metrics
+
+T = TypeVar('T')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+THROTTLED = (403, 429)  # statuses of throttling and ban
+
+# Values of CIRCUIT_STATE
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+CIRCUIT_STATE = metrics.Gauge(
+    'circuit_breaker_state', 'State of the circuit breaker of the host: '
+    '0 closed, 1 half-open, 2 open', ('host',))
+CIRCUIT_TRANSITIONS = metrics.Counter(
+    'circuit_breaker_transitions_total', 'Changes of circuit breaker state '
+    'of the host, by new state', ('host', 'state'))
+RETRIES = metrics.Counter(
+    'upstream_retries_total', 'Failed requests to the host retried after '
+    'backoff', ('host',))
+
+
+class ServerError(Exception):
+    """Upstream answered with 5xx status code"""
+
+    def __init__(self, status: int):
+        super().__init__(f'Server error {status}')
+        self.status = status
+
+
+class ThrottledError(Exception):
+    """Upstream answered with 429 (too many requests) or 403 (ban). Both
+    mean that requests must slow down"""
+
+    def __init__(self, status: int):
+        super().__init__(f'Throttled {status}')
+        self.status = status
+
+
+def check_status(status: int):
+    """Raises error which RetryPolicy backs off on if status tells that
+    upstream is down or throttles requests"""
+    if status >= 500:
+        raise ServerError(status)
+    if status in THROTTLED:
+        raise ThrottledError(status)
+
+
+class CircuitBreaker:
+    """State of one host shared by all users. Opens after failure_threshold
+    failed requests in a row. While it is open nobody sends requests. After
+    reset_timeout a single trial request is let through (half-open): success
+    closes the circuit, failure opens it again."""
+
+    def __init__(self, host: str, failure_threshold: int = 5,
+                 reset_timeout: float = 30):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial = False  # Trial request of half-open state is in flight
+        CIRCUIT_STATE.set(STATE_VALUES[CLOSED], host=host)
+
+    def change_state(self, state: str):
+        if state == self.state:
+            return
+        self.state = state
+        CIRCUIT_STATE.set(STATE_VALUES[state], host=self.host)
+        CIRCUIT_TRANSITIONS.inc(host=self.host, state=state)
+
+    async def wait(self):
+        """Waits until the circuit lets a request through"""
+        while True:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN:
+                remaining = self.opened_at + self.reset_timeout \
+                            - time.monotonic()
+                if remaining <= 0:
+                    self.change_state(HALF_OPEN)
+                else:
+                    # Jitter spreads the fleet after recovery
+                    await asyncio.sleep(remaining + uniform(0, 1))
+                    continue
+            if not self.trial:
+                self.trial = True
+                return
+            await asyncio.sleep(uniform(0.5, 1.5))
+
+    def success(self):
+        self.change_state(CLOSED)
+        self.failures = 0
+        self.trial = False
+
+    def failure(self):
+        self.failures += 1
+        self.trial = False
+        threshold = self.failures >= self.failure_threshold
+        if self.state == HALF_OPEN or self.state == CLOSED and threshold:
+            self.change_state(OPEN)
+            self.opened_at = time.monotonic()
+
+
+class RetryPolicy:
+    """Retries failed requests forever with jittered exponential backoff.
+    Requests to the same host share one CircuitBreaker."""
+
+    def __init__(self, errors: Tuple[Type[BaseException], ...],
+                 base_delay: float = 1, max_delay: float = 60,
+                 failure_threshold: int = 5, reset_timeout: float = 30):
+        """
+        Args:
+            errors: exceptions which mean that request should be retried
+            base_delay: backoff before the second attempt in seconds
+            max_delay: the longest backoff in seconds
+            failure_threshold: failures in a row to open the circuit
+            reset_timeout: seconds before the open circuit is tried again
+        """
+        self.errors = errors
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        if host not in self.breakers:
+            self.breakers[host] = CircuitBreaker(host, self.failure_threshold,
+                                                 self.reset_timeout)
+        return self.breakers[host]
+
+    def backoff(self, attempt: int) -> float:
+        """Returns:
+            Random pause up to the exponential delay of the attempt.
+        """
+        return uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def call(self, host: str, request: Callable[[], Awaitable[T]],
+                   on_error: Callable[[BaseException, int], None]) -> T:
+        """Awaits request until it succeeds.
+        Args:
+            host: host of the request URL
+            request: makes a new request on every call
+            on_error: called with error and attempt number after failure
+        Returns:
+            Result of the first successful request.
+        """
+        breaker = self.breaker(host)
+        attempt = 0
+        while True:
+            await breaker.wait()
+            try:
+                result = await request()
+            except self.errors as error:
+                breaker.failure()
+                on_error(error, attempt)
+                await asyncio.sleep(self.backoff(attempt))
+                attempt += 1
+                RETRIES.inc(host=host)
+            except BaseException:
+                # Cancelled trial request must not block the circuit
+                breaker.trial = False
+                raise
+            else:
+                breaker.success()
+                return result
@@ -1,22 +1,40 @@
 from datetime import timedelta, datetime, date
 from pytz import timezone
 from random import uniform
-from typing import Dict, AsyncIterable, List, Tuple
+from typing import Dict, List, Tuple
+from urllib.parse import urlsplit
 
 import aiohttp
 import asyncio
 import db
-import redis
+import metrics
 import telegram.loggers as loggers
-from aiohttp import ClientSession, ClientTimeout
+from aiohttp import ClientTimeout
 from aiohttp.client_reqrep import ClientResponse
-from config import redis_host
+from config import almaviva_url, redis_host
+from multidict import CIMultiDict, CIMultiDictProxy
+from redis.asyncio import BlockingConnectionPool, Redis
+from redis.exceptions import RedisError
+from encrypting.cache import credentials
 from encrypting.encrypting import fernet
+from .auth import AuthManager, Unauthorized
+from .cadence import CadenceModel
+from .events import BOOKED, SLOTS_SEEN, EventBus
+from .poller import SlotPoller
+from .ratelimit import RateLimiter
+from .responses import Slot, free_slots
+from .retry import RetryPolicy, ServerError, ThrottledError, \
+    check_status
+from .session import SessionManager, request_metrics
+from .snapshots import SnapshotStore
 from .templates.ru.cities import CITIES
 
-REDIS_CLIENT = redis.Redis(host=redis_host)
+# Asyncio client. Waits for a free connection when all of them are busy
+REDIS_CLIENT = Redis(connection_pool=BlockingConnectionPool(
+    host=redis_host, max_connections=50))
 
-HEADERS = {
+# Read-only headers of every request. Users get copies with their token
+HEADERS = CIMultiDictProxy(CIMultiDict({
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0)"
                   " Gecko/20100101 Firefox/114.0",
     "Accept": "application/json, text/plain, */*",
@@ -25,16 +43,70 @@ HEADERS = {
     "Sec-Fetch-Mode": "cors",
     "Sec-Fetch-Site": "same-origin",
     "Sec-GPC": "1"
-}
+}))
 TIMEOUT = ClientTimeout(total=30)
+UPSTREAM_REQUESTS = metrics.Counter(
+    'upstream_requests_total', 'Requests to Almaviva',
+    ('endpoint', 'status'))
+UPSTREAM_SECONDS = metrics.Histogram(
+    'upstream_request_seconds', 'Latency of requests to Almaviva',
+    ('endpoint',))
+SLOT_CLAIMS = metrics.Counter(
+    'slot_claims_total', 'Free slots claimed for validation in Redis cache '
+    '(claimed) or skipped because another user has claimed them (cached)',
+    ('result',))
+EXTRA_BOOKINGS = metrics.Counter(
+    'extra_bookings_total',
+    'Appointments created by concurrent validations after the first one')
+POLL_TO_BOOK = metrics.Histogram(
+    'poll_to_book_seconds',
+    'Time from delivery of a free slot to the successful appointment')
+# Pooled HTTP session shared by all users
+HTTP = SessionManager(TIMEOUT, trace_configs=[
+    request_metrics(UPSTREAM_REQUESTS, UPSTREAM_SECONDS)])
 ALL_TIME_INTERVALS = (
     '09:00', '09:30', '10:00', '10:30', '11:00', '11:30',
     '12:00', '12:30', '13:00', '13:30', '14:00', '14:30'
 )
-URL = 'https://ru.almaviva-visa.services/'
-API_LOGIN = 'https://ru.almaviva-visa.services/api/login'
+URL = almaviva_url
+API_LOGIN = f'{URL}api/login'
+HOST = urlsplit(URL).netloc
+# Endpoints for rate limits
+LOGIN = 'login'
+SLOTS = 'appointment-slots'
+VALIDATION = 'appointments-validation'
+# Ceiling of requests per second and burst size for all users together
+RATE_LIMITER = RateLimiter(
+    limits={LOGIN: (1, 5), SLOTS: (2, 5), VALIDATION: (1, 3)},
+    site_limits={SLOTS: (0.5, 2), VALIDATION: (0.5, 2)}
+)
+# Backoff and circuit breaker shared by all users
+RETRY = RetryPolicy(errors=(
+    aiohttp.ClientConnectionError,
+    aiohttp.ClientOSError,
+    asyncio.TimeoutError,
+    ServerError,
+    ThrottledError
+))
 MOSCOW_TZ = timezone('Etc/GMT-3')
 YEAR = '2023'
+# The last slot lists of all keys shared by bot processes
+SNAPSHOTS = SnapshotStore(REDIS_CLIENT)
+CADENCE = CadenceModel(MOSCOW_TZ, int(YEAR), SNAPSHOTS)
+# Slot sightings and booking outcomes of all bot processes
+EVENTS = EventBus(REDIS_CLIENT)
+EVENTS.subscribe(BOOKED, CADENCE.on_booked)
+# Dates within NEAR_DATES days from tomorrow are polled up to
+# 1 + NEAR_DATES_BOOST times more often than the far ones
+NEAR_DATES = 14
+NEAR_DATES_BOOST = 2
+POLLER = SlotPoller(CADENCE, SNAPSHOTS, EVENTS)
+EVENTS.subscribe(SLOTS_SEEN, POLLER.on_slots_seen)
+# Keeps auth tokens of scanning users fresh
+AUTH = AuthManager(lambda user_id: run_auth(user_id))
+# Validations of one user running at once. All of them still share
+# VALIDATION rate limits
+MAX_VALIDATIONS = 3
 
 
 async def run_auth(user_id: int) -> ClientResponse:
@@ -42,55 +114,85 @@ async def run_auth(user_id: int) -> ClientResponse:
     Returns:
         ClientResponse object.
     """
-    username, password = [
-        fernet.decrypt(data).decode() for data in db.select_data(
-            user_id, db.ACCOUNT, f'{db.USERNAME_ALMA}, {db.PASSWORD_ALMA}'
-        )
-    ]
+    username, password = await credentials.get(
+        user_id, db.USERNAME_ALMA, db.PASSWORD_ALMA)
     json = {"email": username, "password": password}
-    async with ClientSession() as session:
-        async with session.post(url=API_LOGIN, json=json) as response:
-            if response.status == 200:
-                # Updates auth token cookie if auth succeed
-                auth_token = await response.json()
-                db.update_value(
-                    user_id, db.ACCOUNT, db.AUTH_TOKEN,
-                    fernet.encrypt(auth_token['accessToken'].encode())
-                )
-            return response
+    await RATE_LIMITER.acquire(LOGIN)
+    async with HTTP.session.post(url=API_LOGIN, json=json) as response:
+        if response.status == 200:
+            # Updates auth token cookie if auth succeed
+            auth_token = await response.json()
+            await db.aio.update_value(
+                user_id, db.ACCOUNT, db.AUTH_TOKEN,
+                fernet.encrypt(auth_token['accessToken'].encode())
+            )
+            credentials.put(user_id, db.AUTH_TOKEN, auth_token['accessToken'])
+            AUTH.update(user_id, auth_token['accessToken'])
+        return response
+
+
+async def startup():
+    """Prepares state shared by scanners of a bot or worker process"""
+    # Learn polling cadence from previous successful appointments
+    await CADENCE.load()
+    # Receive slot sightings and bookings of other bot processes
+    EVENTS.start()
+
+
+async def shutdown():
+    """Closes connections of scanners. Call after scans have stopped"""
+    # Close pooled connections to Almaviva
+    await HTTP.close()
+    await EVENTS.close()
+    await REDIS_CLIENT.close(close_connection_pool=True)
+    # Write buffered last requests and attempts before exit
+    await db.aio.flush_buffer()
+    await db.aio.database.close()
 
 
 class Appointment:
     def __init__(self, user_id: int):
         self.user_id = user_id
-        self.headers = self.get_headers()
-        self.city = fernet.decrypt(
-            db.select_data(user_id, db.ACCOUNT, db.CITY)[0]).decode()
-        self.attempts = db.select_data(user_id, db.ACCOUNT, db.ATTEMPTS)[0]
-        self.errors = (
-            aiohttp.ClientConnectionError,
-            aiohttp.ClientOSError,
-            asyncio.TimeoutError
-        )
-
-    def get_headers(self) -> Dict:
-        """Creates headers using template and user auth token
-        Returns:
-            Completed headers
-        """
-        auth_token = db.select_data(self.user_id, db.ACCOUNT, db.AUTH_TOKEN)[0]
-        headers = HEADERS
-        headers["Authorization"] = 'Bearer ' + fernet.decrypt(
-            auth_token).decode()
-        return headers
+        # User data is loaded from database in load()
+        self.auth_token = ''
+        self.headers = HEADERS
+        self.city = ''
+        self.site_id = 0
+        self.attempts = 0
+        self.dates_list = []
+        # Poll priority of every date (month, day) and their sum
+        self.weights = {}
+        self.total_weight = 0
+        # News of free slots delivered by POLLER: (month, day, [Slot])
+        self.inbox = asyncio.Queue()
+
+    @metrics.Timer('scanner.load')
+    async def load(self):
+        """Loads user data required for scanning from database"""
+        auth_token, = await credentials.get(self.user_id, db.AUTH_TOKEN)
+        self.set_token(auth_token)
+        self.city, = await credentials.get(self.user_id, db.CITY)
+        self.attempts = (await db.aio.select_data(
+            self.user_id, db.ACCOUNT, db.ATTEMPTS))[0]
+        self.site_id = CITIES[self.city]['id']
 
-    def get_dates_list(self) -> List[Tuple[str, str]]:
+    def set_token(self, auth_token: str):
+        """Creates headers using template and user auth token. Called by
+        AUTH when the token is refreshed. Headers are built once per token
+        and are never changed afterwards, so concurrent requests of other
+        users can't see them"""
+        self.auth_token = auth_token
+        headers = CIMultiDict(HEADERS)
+        headers["Authorization"] = 'Bearer ' + auth_token
+        self.headers = CIMultiDictProxy(headers)
+
+    async def get_dates_list(self) -> List[Tuple[str, str]]:
         """Returns:
             List of tuples with every date (month, day) from the start to the
             final date with one day interval, except weekend.
         """
         st_month, st_day, fin_month, fin_day = [
-            data for data in db.select_data(
+            data for data in await db.aio.select_data(
                 self.user_id, db.ACCOUNT,
                 f'{db.ST_MONTH}, {db.ST_DAY}, {db.FIN_MONTH}, {db.FIN_DAY}'
             )
@@ -113,74 +215,105 @@ class Appointment:
                                    str(next_day.day).zfill(2)))
         return dates_list
 
-    async def find_free_day(self, month: str, day: str
-                            ) -> AsyncIterable | None:
-        """Tries to find a day with free spots.
-        Yields:
-            Free time interval in format 'hh:mm'.
+    def log_error(self, error: BaseException, attempt: int):
+        """Logs failed request. Backoff grows with every attempt, so
+        outages don't flood the log"""
+        loggers.log(self.user_id, f'{error!r}, attempt {attempt + 1}',
+                    loggers.ERROR)
+
+    def get_weights(self, dates_list: List[Tuple[str, str]]
+                    ) -> Dict[Tuple[str, str], float]:
+        """Nearest dates are wanted the most and taken the fastest, so
+        their weight grows linearly from 1 to 1 + NEAR_DATES_BOOST.
+        Returns:
+            Weight of every date (month, day).
+        """
+        tomorrow = date.today() + timedelta(1)
+        weights = {}
+        for month, day in dates_list:
+            days_ahead = (date(int(YEAR), int(month), int(day))
+                          - tomorrow).days
+            nearness = max(0, NEAR_DATES - days_ahead) / NEAR_DATES
+            weights[(month, day)] = 1 + NEAR_DATES_BOOST * nearness
+        return weights
+
+    async def unauthorized(self):
+        """Auth again in case auth token expires. AUTH hands the new token
+        to all appointments of the user. Failed login is logged and backed
+        off by AUTH.
+        Raises:
+            Unauthorized: always.
+        """
+        try:
+            await AUTH.refresh(self.user_id)
+        except Exception:
+            pass
+        raise Unauthorized(self.user_id)
+
+    @metrics.Timer('scanner.find_free_day')
+    async def find_free_day(self, month: str, day: str) -> List[Slot] | None:
+        """Requests slots for the day. Called by POLLER on behalf of all
+        users subscribed to the same city and date.
         Returns:
-            None if not authorized
+            List of time intervals with free spots.
+            None if the response is unknown, so the day is not taken for
+            having no slots.
+        Raises:
+            Unauthorized: auth token is rejected. It is renewed before.
+        Statuses 5xx, 429 and 403 are retried with backoff, which opens the
+        circuit of the host if they repeat.
         """
         # Compile api URL from user data
         url = f"{URL}api/sites/appointment-slots/?date={day}/{month}/" \
-              f"{YEAR}&siteId={CITIES[self.city]['id']}"
-
-        await asyncio.sleep(uniform(5, 10))
-        while True:
-            try:
-                async with ClientSession(timeout=TIMEOUT) as session:
-                    response = await session.get(url, headers=self.headers)
-            except self.errors as error:
-                loggers.log(self.user_id, str(error), loggers.ERROR)
-            else:
-                break
-
-        scanning = f'Scanning... {YEAR}/{month}/{day}'
-        current_time = datetime.now(MOSCOW_TZ).strftime('%H:%M:%S')
-        db.update_value(self.user_id, db.ACCOUNT, db.LAST_REQUEST,
-                        current_time)
-        loggers.log(self.user_id, scanning)
-
-        if await response.json():
-            try:
-                for line in await response.json():
-                    if line and line['freeSpots']:
-                        yield line['time']
-            except self.errors as error:
-                loggers.log(self.user_id, error, loggers.ERROR)
-        elif response.status == 401:
+              f"{YEAR}&siteId={self.site_id}"
+
+        async def request() -> Tuple[int, bytes]:
+            await RATE_LIMITER.acquire(SLOTS, self.site_id)
+            async with HTTP.session.get(url, headers=self.headers) as response:
+                check_status(response.status)
+                return response.status, await response.read()
+
+        status, body = await RETRY.call(HOST, request, self.log_error)
+        if status == 401:
+            await self.unauthorized()
+        if status != 200:
+            loggers.log(self.user_id, f'{status} {body[:200]!r}: Unknown '
+                                      f'response', loggers.WARNING)
             return
+        return free_slots(body)
 
-    async def find_free_time(self, month: str, day: str, time: str) -> bool:
+    @metrics.Timer('scanner.find_free_time')
+    async def find_free_time(self, month: str, day: str,
+                             time: str) -> bool | None:
         """Tries to create an appointment with the completed template.
         Returns:
             True, if an appointment was successfully created.
-            False otherwise.
+            False, if the time interval is occupied.
+            None if the response is unknown.
+        Raises:
+            Unauthorized: auth token is rejected. It is renewed before.
         """
         url = f"{URL}api/sites/appointments-validation/?siteId=" \
-              f"{CITIES[self.city]['id']}&appointmentDate={day}/" \
+              f"{self.site_id}&appointmentDate={day}/" \
               f"{month}/{YEAR}&appointmentTime={time}&persons=1"
         await asyncio.sleep(uniform(5, 15))
-        while True:
-            try:
-                async with ClientSession(timeout=TIMEOUT) as session:
-                    response = await session.get(url=url, headers=self.headers)
-            except self.errors as error:
-                loggers.log(self.user_id, error, loggers.ERROR)
-            else:
-                break
-
-        if await response.text() == 'true':
-            success_row = (self.user_id, int(month), int(day), time,
-                           self.attempts)
-            db.insert_row(db.SUCCESS, '', success_row)
-            db.update_value(self.user_id, db.ACCOUNT, db.ATTEMPTS, 0)
-            loggers.log(self.user_id, f'{self.user_id} completed')
+
+        async def request() -> Tuple[int, str]:
+            await RATE_LIMITER.acquire(VALIDATION, self.site_id)
+            async with HTTP.session.get(url=url,
+                                        headers=self.headers) as response:
+                check_status(response.status)
+                return response.status, (await response.read()).decode()
+
+        status, text = await RETRY.call(HOST, request, self.log_error)
+        if status == 401:
+            await self.unauthorized()
+        if text == 'true':
             return True
-        elif await response.text() == 'false':
+        elif text == 'false':
             current_time = datetime.now(MOSCOW_TZ).strftime('%H:%M:%S')
             self.attempts += 1
-            db.update_values(
+            await db.aio.update_values(
                 self.user_id,
                 db.ACCOUNT,
                 (db.LAST_REQUEST, db.ATTEMPTS),
@@ -193,34 +326,144 @@ class Appointment:
         else:
             loggers.log(
                 self.user_id,
-                f'{str(response.status)} {response.text()}: Unknown response',
+                f'{str(status)} {text}: Unknown response',
                 loggers.WARNING
             )
 
-    async def run_scanning(self) -> Tuple[str, str, str] | None:
+    async def save_success(self, month: str, day: str, time: str):
+        success_row = (self.user_id, int(month), int(day), time,
+                       self.attempts)
+        await db.aio.insert_row(db.SUCCESS, '', success_row)
+        await db.aio.update_value(self.user_id, db.ACCOUNT, db.ATTEMPTS, 0)
+        loggers.log(self.user_id, f'{self.user_id} completed')
+        try:
+            await EVENTS.publish(BOOKED, {'site_id': self.site_id,
+                                          'month': month, 'day': day,
+                                          'time': time})
+        except RedisError as error:
+            loggers.log(self.user_id, str(error), loggers.ERROR)
+
+    async def claim(self, cached_time: str) -> bool:
+        """Only the user who sets the key in cache validates the time
+        interval.
+        Returns:
+            True if the user has claimed the time interval.
+        """
+        with metrics.Timer('scanner.claim'):
+            claimed = await REDIS_CLIENT.set(cached_time, 0, ex=240, nx=True)
+        if claimed:
+            SLOT_CLAIMS.inc(result='claimed')
+        else:
+            SLOT_CLAIMS.inc(result='cached')
+            loggers.log(self.user_id, f'{cached_time} in cache')
+        return bool(claimed)
+
+    async def release(self, cached_time: str):
+        """Lets other users validate the time interval at once"""
+        try:
+            await REDIS_CLIENT.delete(cached_time)
+        except RedisError as error:
+            loggers.log(self.user_id, str(error), loggers.ERROR)
+
+    @metrics.Timer('scanner.validate')
+    async def validate(self, month: str, day: str,
+                       times: List[str]) -> Tuple[str, List[str]] | None:
+        """Races validations of all free time intervals of the day, at
+        most MAX_VALIDATIONS at once. Time interval is claimed when its
+        validation starts. Validations left are cancelled after the first
+        success, before it is saved. Claim is kept only if the time interval
+        is booked or occupied, otherwise others may validate it at once.
+        Returns:
+            Time interval of successful appointment and time intervals of
+            extra appointments created by concurrent validations.
+            None if every validation failed.
+        """
+        semaphore = asyncio.Semaphore(MAX_VALIDATIONS)
+
+        async def attempt(time: str) -> str | None:
+            async with semaphore:
+                cached_time = f"{self.city}{month}{day}{time}"
+                if not await self.claim(cached_time):
+                    return
+                try:
+                    validated = await self.find_free_time(month, day, time)
+                except BaseException:
+                    # Time interval is not validated, so others may try it
+                    await self.release(cached_time)
+                    raise
+                if validated:
+                    return time
+                # Only occupied time interval keeps the claim
+                if validated is None:
+                    await self.release(cached_time)
+
+        tasks = [asyncio.create_task(attempt(time)) for time in times]
+        booked = None
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    booked = await next_done
+                except Unauthorized as error:
+                    loggers.log(self.user_id, str(error), loggers.WARNING)
+                    continue
+                except Exception as error:
+                    loggers.log(self.user_id, str(error), loggers.ERROR)
+                    continue
+                if booked is not None:
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+        if booked is None:
+            return
+        # Validations which have finished meanwhile have created appointments
+        # too. Almaviva keeps them, so they are reported, not dropped
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        extra_times = [time for time in results
+                       if isinstance(time, str) and time != booked]
+        for time in extra_times:
+            EXTRA_BOOKINGS.inc()
+            loggers.log(self.user_id,
+                        f'{self.user_id} extra appointment {YEAR}/'
+                        f'{month}/{day} {time}', loggers.WARNING)
+        await self.save_success(month, day, booked)
+        return booked, extra_times
+
+    async def run_scanning(self) -> Tuple[str, str, str, List[str]] | None:
         """Runs scanning until successful appointment is created or user
         cancels scanning.
         Returns:
-            Tuple(month, day, time interval) if successful appointment is
-            created.
+            Tuple(month, day, time interval, time intervals of extra
+            appointments) if successful appointment is created.
             None if dates_list is empty, because dates are invalid or expired.
         """
-        dates_list = self.get_dates_list()
+        await self.load()
+        dates_list = await self.get_dates_list()
         if not dates_list:
             return
-        while True:
+        self.dates_list = dates_list
+        self.weights = self.get_weights(dates_list)
+        self.total_weight = sum(self.weights.values())
+        AUTH.watch(self)
+        for month, day in dates_list:
+            POLLER.subscribe(self, month, day)
+        try:
+            while True:
+                month, day, slots = await self.inbox.get()
+                delivered = asyncio.get_running_loop().time()
+                scanning = f'Scanning... {YEAR}/{month}/{day}'
+                current_time = datetime.now(MOSCOW_TZ).strftime('%H:%M:%S')
+                await db.aio.update_value(self.user_id, db.ACCOUNT,
+                                          db.LAST_REQUEST, current_time)
+                loggers.log(self.user_id, scanning)
+                if slots:
+                    booked = await self.validate(
+                        month, day, [slot.time for slot in slots])
+                    if booked is not None:
+                        POLL_TO_BOOK.observe(
+                            asyncio.get_running_loop().time() - delivered)
+                        return month, day, *booked
+        finally:
+            AUTH.unwatch(self)
             for month, day in dates_list:
-                free_day = self.find_free_day(month, day)
-                # Auth again in case auth token expires
-                if free_day is None:
-                    await run_auth(self.user_id)
-                async for time in free_day:
-                    # At first check cache
-                    cached_time = f"{self.city}{month}{day}{time}"
-                    if REDIS_CLIENT.get(cached_time) is None:
-                        REDIS_CLIENT.set(cached_time, 0, ex=240)
-                        if await self.find_free_time(month, day, time):
-                            return month, day, time
-                    else:
-                        await asyncio.sleep(uniform(1, 4))
-                        loggers.log(self.user_id, f'{cached_time} in cache')
+                POLLER.unsubscribe(self, month, day)
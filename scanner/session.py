@@ -0,0 +1,97 @@
+import time
+from types import SimpleNamespace
+from typing import List
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig
+from aiohttp.tracing import TraceRequestEndParams, \
+    TraceRequestExceptionParams, TraceRequestStartParams
+from metrics import Counter, Histogram
+from yarl import URL
+
+
+def endpoint_name(url: URL) -> str:
+    """Returns:
+        The last segment of URL path: 'login', 'appointment-slots', etc.
+    """
+    return url.path.rstrip('/').rsplit('/', 1)[-1]
+
+
+def request_metrics(requests: Counter, seconds: Histogram) -> TraceConfig:
+    """Counts requests by endpoint and status (exception name if request
+    failed) and measures their latency by endpoint"""
+
+    async def on_request_start(session: ClientSession,
+                               context: SimpleNamespace,
+                               params: TraceRequestStartParams):
+        context.start = time.perf_counter()
+
+    async def on_request_end(session: ClientSession,
+                             context: SimpleNamespace,
+                             params: TraceRequestEndParams):
+        endpoint = endpoint_name(params.url)
+        requests.inc(endpoint=endpoint, status=params.response.status)
+        seconds.observe(time.perf_counter() - context.start,
+                        endpoint=endpoint)
+
+    async def on_request_exception(session: ClientSession,
+                                   context: SimpleNamespace,
+                                   params: TraceRequestExceptionParams):
+        requests.inc(endpoint=endpoint_name(params.url),
+                     status=type(params.exception).__name__)
+
+    trace_config = TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+class SessionManager:
+    """Keeps one long-lived ClientSession for all requests to Almaviva.
+    Connections are reused between polls of all users instead of making
+    a new TCP+TLS handshake for every request."""
+
+    def __init__(self, timeout: ClientTimeout, limit: int = 100,
+                 limit_per_host: int = 50, ttl_dns_cache: int = 300,
+                 keepalive_timeout: int = 60,
+                 trace_configs: List[TraceConfig] | None = None):
+        """
+        Args:
+            timeout: default timeout of every request
+            limit: total number of simultaneous connections
+            limit_per_host: number of simultaneous connections to one host
+            ttl_dns_cache: time in seconds to cache resolved DNS records
+            keepalive_timeout: time in seconds to keep idle connection open
+            trace_configs: request tracing hooks, e.g. for benchmarks
+        """
+        self.timeout = timeout
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.ttl_dns_cache = ttl_dns_cache
+        self.keepalive_timeout = keepalive_timeout
+        self.trace_configs = trace_configs or []
+        self._session = None
+
+    @property
+    def session(self) -> ClientSession:
+        """Returns:
+            Shared session. Creates it on the first call inside the event
+            loop or after it was closed.
+        """
+        if self._session is None or self._session.closed:
+            connector = TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.ttl_dns_cache,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            self._session = ClientSession(connector=connector,
+                                          timeout=self.timeout,
+                                          trace_configs=self.trace_configs)
+        return self._session
+
+    async def close(self):
+        """Closes shared session and all its connections"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
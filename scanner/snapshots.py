@@ -0,0 +1,149 @@
+import time
+from typing import Dict, List, Tuple
+
+from orjson import dumps, loads
+from redis.asyncio import Redis
+from redis.exceptions import WatchError
+from .responses import Slot
+
+# (siteId, month, day)
+Key = Tuple[int, str, str]
+
+APPEARED = 'appeared'
+VANISHED = 'vanished'
+PREFIX = 'slots'
+HISTORY = f'{PREFIX}:history'
+HISTORY_SIZE = 10000  # the latest events kept in the history list
+SNAPSHOT_TTL = 2 * 24 * 3600  # seconds to keep snapshot of unpolled key
+
+
+class SlotEvent:
+    """Change of a time interval between two snapshots of a key"""
+    __slots__ = ('kind', 'key', 'time', 'free_spots', 'version', 'fetched')
+
+    def __init__(self, kind: str, key: Key, time: str, free_spots: int,
+                 version: int, fetched: float):
+        self.kind = kind
+        self.key = key
+        self.time = time
+        self.free_spots = free_spots
+        self.version = version
+        self.fetched = fetched  # Unix time of the snapshot
+
+    def __repr__(self) -> str:
+        return f'SlotEvent({self.kind!r}, {self.key}, {self.time!r}, ' \
+               f'{self.free_spots}, v{self.version})'
+
+    def dumps(self) -> bytes:
+        return dumps((self.kind, *self.key, self.time, self.free_spots,
+                      self.version, self.fetched))
+
+    @classmethod
+    def loads(cls, raw: bytes) -> 'SlotEvent':
+        kind, site_id, month, day, time, free_spots, version, fetched = \
+            loads(raw)
+        return cls(kind, (site_id, month, day), time, free_spots, version,
+                   fetched)
+
+
+class Snapshot:
+    """The last slot list of a key stored in Redis"""
+    __slots__ = ('version', 'fetched', 'slots')
+
+    def __init__(self, version: int, fetched: float, slots: List[Slot]):
+        self.version = version
+        self.fetched = fetched
+        self.slots = slots
+
+
+def diff(key: Key, previous: List[Slot], current: List[Slot], version: int,
+         fetched: float) -> List[SlotEvent]:
+    """Returns:
+        Events turning previous slot list into current one.
+    """
+    before = {slot.time: slot.free_spots for slot in previous}
+    after = {slot.time: slot.free_spots for slot in current}
+    events = [SlotEvent(APPEARED, key, time, free_spots, version, fetched)
+              for time, free_spots in after.items() if time not in before]
+    events.extend(SlotEvent(VANISHED, key, time, free_spots, version, fetched)
+                  for time, free_spots in before.items() if time not in after)
+    return events
+
+
+class SnapshotStore:
+    """Versioned snapshots of free slots of every (siteId, date) key kept in
+    Redis, so all bot processes share them. Version grows only when the slot
+    list changes, every change is recorded to the capped history list."""
+
+    def __init__(self, redis: Redis, history_size: int = HISTORY_SIZE,
+                 ttl: int = SNAPSHOT_TTL):
+        """
+        Args:
+            redis: client of the shared Redis
+            history_size: number of the latest events kept in history
+            ttl: seconds to keep snapshot of a key nobody polls
+        """
+        self.redis = redis
+        self.history_size = history_size
+        self.ttl = ttl
+
+    @staticmethod
+    def name(key: Key) -> str:
+        site_id, month, day = key
+        return f'{PREFIX}:{site_id}:{month}:{day}'
+
+    @staticmethod
+    def parse(raw: Dict[bytes, bytes]) -> Snapshot | None:
+        if not raw:
+            return None
+        slots = [Slot(time, free_spots)
+                 for time, free_spots in loads(raw[b'slots'])]
+        return Snapshot(int(raw[b'version']), float(raw[b'fetched']), slots)
+
+    async def get(self, key: Key) -> Snapshot | None:
+        return self.parse(await self.redis.hgetall(self.name(key)))
+
+    async def update(self, key: Key,
+                     slots: List[Slot]) -> Tuple[int, List[SlotEvent]]:
+        """Stores the fresh slot list of the key.
+        Returns:
+            Tuple(version of the stored snapshot, events since the previous
+            one). Events are empty if nothing changed.
+        """
+        name = self.name(key)
+        async with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    # Another process may update the key at the same time
+                    await pipe.watch(name)
+                    previous = self.parse(await pipe.hgetall(name))
+                    fetched = time.time()
+                    version = previous.version if previous else 0
+                    events = diff(key, previous.slots if previous else [],
+                                  slots, version + 1, fetched)
+                    if events or previous is None:
+                        version += 1
+                    pipe.multi()
+                    pipe.hset(name, mapping={
+                        'version': version,
+                        'fetched': fetched,
+                        'slots': dumps([(slot.time, slot.free_spots)
+                                        for slot in slots])
+                    })
+                    pipe.expire(name, self.ttl)
+                    if events:
+                        pipe.lpush(HISTORY,
+                                   *(event.dumps() for event in events))
+                        pipe.ltrim(HISTORY, 0, self.history_size - 1)
+                    await pipe.execute()
+                    return version, events
+                except WatchError:
+                    continue
+
+    async def history(self, count: int | None = None) -> List[SlotEvent]:
+        """Returns:
+            The latest events, newest first.
+        """
+        end = -1 if count is None else count - 1
+        return [SlotEvent.loads(raw)
+                for raw in await self.redis.lrange(HISTORY, 0, end)]
@@ -2,3 +2,4 @@ from .bot import dp
 from .middleware import ThrottlingMiddleware, rate_limit
 from .loggers import *
 from .scheduler import run_schedule
+from .webhook import WebhookHandler
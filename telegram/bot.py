@@ -1,54 +1,131 @@
+import threading
 from datetime import datetime
-from typing import Dict
+from io import BytesIO
+from typing import Dict, Iterable, Set
 
 import asyncio
+import cluster
 import db
+import metrics
+import time
 from . import loggers
 from . import message_names as msg
 from . import middleware as md
 from . import keyboards as kb
+from .supervisor import TaskSupervisor
 from aiogram import Bot, Dispatcher
 from aiogram.contrib.fsm_storage import redis
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import Message, CallbackQuery, InputFile
 from asyncio.exceptions import CancelledError
-from config import token, admin_id, bot_storage_host
+from config import token, admin_id, bot_storage_host, scan_mode
+from encrypting.cache import credentials
 from encrypting.encrypting import fernet
-from scanner import Appointment, YEAR, MOSCOW_TZ, run_auth
+from scanner import Appointment, YEAR, MOSCOW_TZ, run_auth, CADENCE, \
+    REDIS_CLIENT
+from scanner.events import node_id
+from scanner.templates.ru.cities import CITIES
 
-bot = Bot(token=token)
+PROFILE_SECONDS = 10  # default duration of /profile
+MAX_PROFILE_SECONDS = 120
+MAX_MESSAGE_LENGTH = 4096
+
+TELEGRAM_SECONDS = metrics.Histogram(
+    'telegram_request_seconds', 'Latency of Telegram Bot API requests',
+    ('method',))
+
+
+class TimedBot(Bot):
+    """Bot which measures latency of every Bot API request"""
+
+    async def request(self, method: str, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().request(method, *args, **kwargs)
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - start,
+                                     method=method)
+
+
+bot = TimedBot(token=token)
 dp = Dispatcher(bot, storage=redis.RedisStorage2(host=bot_storage_host))
 ADMIN_ID = int(admin_id)
 
-modify_user = 0  # Single user telegram ID to act with. Only for admin.
-users = {}  # User's telegram IDs
-tasks = set()  # Initial tasks
-gather_task = asyncio.gather(*tasks)
+# Scanning tasks of users. Crashed scanner is restarted a few times, then
+# the user is stopped
+supervisor = TaskSupervisor(lambda user_id: dp_run_scanning(user_id),
+                            on_failure=lambda user_id: cancel_task(user_id))
+# Scan jobs of worker processes. None if the bot scans by itself. Set up
+# by setup_jobs(), because cluster imports telegram.loggers and so this
+# module, and may be not initialized yet at import time
+JOBS: 'cluster.JobQueue | None' = None
+SCANNING_USERS = metrics.Gauge('scanning_users',
+                               'Scanning tasks of this process',
+                               func=lambda: len(supervisor))
+
+
+def setup_jobs():
+    """Sends scans to worker processes in scan mode 'workers'"""
+    global JOBS
+    if scan_mode == cluster.WORKERS:
+        JOBS = cluster.JobQueue(REDIS_CLIENT)
+
+
+async def create_tasks(user_ids: Iterable[int]):
+    """Creates scanning tasks for users"""
+    user_ids = tuple(user_ids)
+    if JOBS is not None:
+        # Workers share jobs out by city
+        await JOBS.start_many({user_id: await site_id(user_id)
+                               for user_id in user_ids})
+    else:
+        supervisor.start_many(user_ids)
+    start_time = datetime.now(MOSCOW_TZ).strftime('%m/%d %H:%M')
+    await db.aio.update_users(user_ids, db.ACCOUNT,
+                              (db.START_TIME, db.IS_ACTIVE),
+                              (start_time, True))
+    for user_id in user_ids:
+        loggers.log(user_id, msg.SCAN_STARTED, loggers.INFO)
+
+
+async def site_id(user_id: int) -> int:
+    """Returns:
+        Almaviva site id of the user's city.
+    """
+    city, = await credentials.get(user_id, db.CITY)
+    return CITIES[city]['id']
 
 
 async def create_task(user_id: int):
     """Creates scanning task for user"""
-    global tasks, gather_task, users
-    task = asyncio.create_task(dp_run_scanning(user_id))
-    users[user_id] = task
-    tasks.add(task)
-    gather_task = asyncio.gather(*tasks)
-    start_time = datetime.now(MOSCOW_TZ).strftime('%m/%d %H:%M')
-    db.update_values(user_id, db.ACCOUNT,
-                     (db.START_TIME, db.IS_ACTIVE), (start_time, True))
-    loggers.log(user_id, msg.SCAN_STARTED, loggers.INFO)
+    await create_tasks((user_id,))
+
+
+async def cancel_tasks(user_ids: Iterable[int]):
+    """Cancels scanning tasks for users"""
+    user_ids = tuple(user_ids)
+    if JOBS is not None:
+        await JOBS.stop_many(user_ids)
+    else:
+        supervisor.stop_many(user_ids)
+    for user_id in user_ids:
+        loggers.log(user_id, msg.SCAN_CANCELLED)
+    await db.aio.update_users(user_ids, db.ACCOUNT, (db.IS_ACTIVE,), (False,))
+    for user_id in user_ids:
+        loggers.log(user_id, msg.SCAN_STOPPED, loggers.INFO)
 
 
 async def cancel_task(user_id: int):
     """Cancels scanning task for user"""
-    global tasks, gather_task, users
-    task = users[user_id]
-    task.cancel()
-    loggers.log(user_id, msg.SCAN_CANCELLED)
-    tasks.remove(task)
-    gather_task = asyncio.gather(*tasks)
-    del users[user_id]
-    db.update_value(user_id, db.ACCOUNT, db.IS_ACTIVE, False)
-    loggers.log(user_id, msg.SCAN_STOPPED, loggers.INFO)
+    await cancel_tasks((user_id,))
+
+
+async def get_active_users() -> Set[int]:
+    """Returns:
+        IDs of users with launched scanner.
+    """
+    if JOBS is not None:
+        return await JOBS.active()
+    return set(supervisor)
 
 
 # User handlers
@@ -58,20 +135,23 @@ async def cancel_task(user_id: int):
 async def dp_start(message: Message):
     """Sends greeting message. If user has already launched scanning or is
     banned, sends corresponding messages"""
-    user_id_exists = db.user_id_exists(message.from_user.id, db.ACCOUNT)
+    user_id_exists = await db.aio.user_id_exists(message.from_user.id,
+                                                 db.ACCOUNT)
     if user_id_exists:
-        is_active = db.select_data(message.from_user.id, db.ACCOUNT,
-                                   db.IS_ACTIVE)[0]
+        is_active = (await db.aio.select_data(
+            message.from_user.id, db.ACCOUNT, db.IS_ACTIVE))[0]
     else:
         # Create 4 tables if user does not exist
         for table in (db.ACCOUNT, db.BANNED):
-            db.insert_row(table, (db.USER_ID,), (message.from_user.id,))
+            await db.aio.insert_row(table, (db.USER_ID,),
+                                    (message.from_user.id,))
         is_active = False
 
     if is_active:
         await message.answer(msg.SCAN_UNIQUE)
     else:
-        banned = db.select_data(message.from_user.id, db.BANNED, db.BAN)[0]
+        banned = (await db.aio.select_data(message.from_user.id, db.BANNED,
+                                           db.BAN))[0]
         if banned:
             await message.answer(msg.BANNED)
         else:
@@ -91,8 +171,10 @@ async def dp_username(callback: CallbackQuery):
 @dp.message_handler(state='0')
 async def dp_password(message: Message):
     """Requests password from Almaviva account"""
-    db.update_value(message.from_user.id, db.ACCOUNT, db.USERNAME_ALMA,
-                    fernet.encrypt(message.text.encode()))
+    await db.aio.update_value(message.from_user.id, db.ACCOUNT,
+                              db.USERNAME_ALMA,
+                              fernet.encrypt(message.text.encode()))
+    credentials.invalidate(message.from_user.id, db.USERNAME_ALMA)
     await message.answer(msg.ENTER_PASSWORD_ALMA)
     await dp.current_state().set_state('1')
 
@@ -101,8 +183,10 @@ async def dp_password(message: Message):
 async def dp_choose_city(message: Message):
     """Tries to authorize with entered email and password. If succeeded,
     requests city to appoint. Otherwise, sends warning message"""
-    db.update_value(message.from_user.id, db.ACCOUNT, db.PASSWORD_ALMA,
-                    fernet.encrypt(message.text.encode()))
+    await db.aio.update_value(message.from_user.id, db.ACCOUNT,
+                              db.PASSWORD_ALMA,
+                              fernet.encrypt(message.text.encode()))
+    credentials.invalidate(message.from_user.id, db.PASSWORD_ALMA)
     response = await run_auth(message.from_user.id)
     if response.status == 200:
         loggers.log(message.from_user.id, msg.AUTH_200, loggers.INFO)
@@ -138,8 +222,9 @@ async def dp_start_date(callback: CallbackQuery):
     """Shows inline calendar. Requests start date to appoint"""
     await callback.message.delete()
     await bot.send_message(callback.from_user.id, callback.data)
-    db.update_value(callback.from_user.id, db.ACCOUNT, db.CITY,
-                    fernet.encrypt(callback.data.encode()))
+    await db.aio.update_value(callback.from_user.id, db.ACCOUNT, db.CITY,
+                              fernet.encrypt(callback.data.encode()))
+    credentials.invalidate(callback.from_user.id, db.CITY)
     await callback.message.answer(
         msg.CHOOSE_START_DATE,
         reply_markup=await kb.Calendar().start_calendar()
@@ -153,7 +238,7 @@ async def dp_final_date(callback: CallbackQuery, callback_data: Dict):
     selected, single_date = await kb.Calendar().process_selection(
         callback, callback_data)
     if selected:
-        db.update_values(
+        await db.aio.update_values(
             callback.from_user.id,
             db.ACCOUNT,
             (db.ST_MONTH, db.ST_DAY),
@@ -178,8 +263,8 @@ async def dp_check_acc(callback: CallbackQuery, callback_data: Dict):
     """Request user for input data correctness:
      1. If data is not correct return to input number of persons.
      2. If data is correct, proceed to input (Person 1)"""
-    month = db.select_data(callback.from_user.id, db.ACCOUNT, db.ST_MONTH)[0]
-    day = db.select_data(callback.from_user.id, db.ACCOUNT, db.ST_DAY)[0]
+    month, day = await db.aio.select_data(
+        callback.from_user.id, db.ACCOUNT, f'{db.ST_MONTH}, {db.ST_DAY}')
     start_date = datetime(int(YEAR), month, day)
 
     selected, single_date = await kb.Calendar(start_date).process_selection(
@@ -187,7 +272,7 @@ async def dp_check_acc(callback: CallbackQuery, callback_data: Dict):
     if selected:
         await bot.send_message(callback.from_user.id,
                                single_date.strftime("%d/%m/%Y"))
-        db.update_values(
+        await db.aio.update_values(
             callback.from_user.id,
             db.ACCOUNT,
             (db.FIN_MONTH, db.FIN_DAY),
@@ -227,7 +312,8 @@ async def dp_check_scanning(message: Message):
 @md.rate_limit()
 async def dp_delete_acc(message: Message):
     """If user ID exists, requests to delete account"""
-    user_id_exists = db.user_id_exists(message.from_user.id, db.ACCOUNT)
+    user_id_exists = await db.aio.user_id_exists(message.from_user.id,
+                                                 db.ACCOUNT)
     if user_id_exists:
         await message.answer(msg.ACC_DELETE, reply_markup=kb.acc_delete())
     else:
@@ -238,11 +324,12 @@ async def dp_delete_acc(message: Message):
 @dp.callback_query_handler(text=msg.CALLBACK_ACC_DELETE)
 async def dp_delete_acc_callback(callback: CallbackQuery):
     """Stops scanning and deletes all tables, except 'banned'"""
-    is_active = db.select_data(callback.from_user.id, db.ACCOUNT,
-                               db.IS_ACTIVE)[0]
+    is_active = (await db.aio.select_data(callback.from_user.id, db.ACCOUNT,
+                                          db.IS_ACTIVE))[0]
     if is_active:
         await cancel_task(callback.from_user.id)
-    db.delete_user(callback.from_user.id)
+    await db.aio.delete_user(callback.from_user.id)
+    credentials.invalidate(callback.from_user.id)
     await callback.answer()
     await callback.message.answer(msg.ACC_DELETED)
 
@@ -253,22 +340,52 @@ async def dp_run_scanning(user_id: int):
         app_result = await Appointment(user_id).run_scanning()
     except CancelledError:
         app_result = False
+    # Scan has returned. Supervisor restarts crashed scans only, so errors
+    # of reporting must not leave the task
+    try:
+        await report_result(user_id, app_result)
+    except Exception as error:
+        loggers.log(user_id, str(error), loggers.ERROR)
+
 
+async def report_result(user_id: int,
+                        app_result: 'cluster.jobs.ScanResult | bool'):
+    """Sends message about result of scanning and stops it"""
     # Successful appointment
     if app_result:
-        month, day, free_time = [data for data in app_result]
-        await bot.send_message(
-            user_id, msg.successful_appointment(YEAR, month, day, free_time)
-        )
+        month, day, free_time, extra_times = [data for data in app_result]
         loggers.log(
             user_id,
             msg.successful_appointment(YEAR, month, day, free_time),
             loggers.INFO
         )
-        await cancel_task(user_id)
+        # Scan is stopped before the user is notified, so a failed message
+        # can't leave the user active for the next rerun
+        await stop_finished(user_id)
+        await bot.send_message(
+            user_id, msg.successful_appointment(YEAR, month, day, free_time)
+        )
+        if extra_times:
+            await bot.send_message(
+                user_id, msg.extra_appointments(YEAR, month, day, extra_times)
+            )
     elif app_result is None:
         loggers.log(user_id, msg.WRONG_DATES, loggers.WARNING)
+        await stop_finished(user_id)
+
+
+async def stop_finished(user_id: int):
+    """Stops the scan which has returned. Errors are logged only, because
+    the scan must not run again"""
+    try:
         await cancel_task(user_id)
+    except Exception as error:
+        loggers.log(user_id, str(error), loggers.ERROR)
+
+
+async def read_results():
+    """Reports results of worker processes"""
+    await JOBS.read_results(node_id(), report_result)
 
 
 # Admin handlers
@@ -296,10 +413,11 @@ async def dp_admin_stop(message: Message):
 @dp.message_handler(commands=['start_ready_users'], state=msg.ADMIN)
 async def dp_start_users(message: Message):
     """Starts scanning for all users with filled data"""
-    for user_id in db.get_ready_users():
-        await run_auth(user_id)
-        await create_task(user_id)
-        await message.answer(msg.admin_start_user(user_id))
+    ready_users = tuple(await db.aio.get_ready_users())
+    # Users start at once with their stored tokens. Scanner logs in again on
+    # 401, a few users at a time, so logins don't hold up everybody
+    await create_tasks(ready_users)
+    await message.answer(msg.admin_start_users(len(ready_users)))
 
 
 @dp.message_handler(commands=['user'], state=msg.ADMIN)
@@ -309,11 +427,19 @@ async def dp_choose_user(message: Message):
     await dp.current_state().set_state(msg.ACTION)
 
 
+async def get_modify_user() -> int:
+    """Returns:
+        Single user telegram ID to act with. Only for admin.
+    """
+    return (await dp.current_state().get_data()).get('modify_user', 0)
+
+
 @dp.message_handler(lambda message: message.text.isdigit(), state=msg.ACTION)
 async def dp_choose_action(message: Message):
     """Shows admin panel to interact with user id"""
-    global modify_user
-    modify_user = int(message.text)
+    # Kept in FSM storage, so the next update of admin can go to another
+    # replica of the bot
+    await dp.current_state().update_data(modify_user=int(message.text))
     await message.answer(msg.CHOOSE_ADMIN_ACTION,
                          reply_markup=kb.admin_panel())
 
@@ -321,77 +447,79 @@ async def dp_choose_action(message: Message):
 @dp.callback_query_handler(text=msg.CALLBACK_START, state=msg.ACTION)
 async def dp_create_task(callback: CallbackQuery):
     """Launches scanner for single user only with filled data"""
-    global modify_user
-    if modify_user in db.get_ready_users():
+    modify_user = await get_modify_user()
+    if modify_user in await db.aio.get_ready_users():
         await run_auth(modify_user)
         await create_task(modify_user)
         await callback.answer()
         await callback.message.answer(msg.admin_start_user(modify_user))
     else:
         await callback.message.answer(msg.USER_NOT_FOUND)
-    modify_user = 0
+    await dp.current_state().reset_data()
     await dp.current_state().set_state(msg.ADMIN)
 
 
 @dp.callback_query_handler(text=msg.CALLBACK_STOP, state=msg.ACTION)
 async def dp_cancel_task(callback: CallbackQuery):
     """Stops scanner for single user"""
-    global modify_user
+    modify_user = await get_modify_user()
     await cancel_task(modify_user)
     await callback.answer()
     await callback.message.answer(msg.SCAN_STOPPED)
-    modify_user = 0
+    await dp.current_state().reset_data()
     await dp.current_state().set_state(msg.ADMIN)
 
 
 @dp.callback_query_handler(text=msg.CALLBACK_BAN, state=msg.ACTION)
 async def dp_ban(callback: CallbackQuery):
     """Bans user"""
-    global modify_user
-    db.update_value(modify_user, db.BANNED, db.BAN, True)
+    modify_user = await get_modify_user()
+    await db.aio.update_value(modify_user, db.BANNED, db.BAN, True)
     await callback.answer()
     await callback.message.answer(msg.admin_user_ban(modify_user))
-    modify_user = 0
+    await dp.current_state().reset_data()
     await dp.current_state().set_state(msg.ADMIN)
 
 
 @dp.callback_query_handler(text=msg.CALLBACK_UNBAN, state=msg.ACTION)
 async def dp_unban(callback: CallbackQuery):
     """Unbans user"""
-    global modify_user
-    db.update_value(modify_user, db.BANNED, db.BAN, False)
+    modify_user = await get_modify_user()
+    await db.aio.update_value(modify_user, db.BANNED, db.BAN, False)
     await callback.answer()
     await callback.message.answer(msg.admin_user_unban(modify_user))
-    modify_user = 0
+    await dp.current_state().reset_data()
     await dp.current_state().set_state(msg.ADMIN)
 
 
 @dp.callback_query_handler(text=msg.CALLBACK_USER_DELETE, state=msg.ACTION)
 async def dp_delete_user(callback: CallbackQuery):
     """Deletes user"""
-    global modify_user
-    user_id_exists = db.user_id_exists(modify_user, db.ACCOUNT)
+    modify_user = await get_modify_user()
+    user_id_exists = await db.aio.user_id_exists(modify_user, db.ACCOUNT)
     if user_id_exists:
-        is_active = db.select_data(modify_user, db.ACCOUNT, db.IS_ACTIVE)[0]
+        is_active = (await db.aio.select_data(modify_user, db.ACCOUNT,
+                                              db.IS_ACTIVE))[0]
         if is_active:
             await cancel_task(modify_user)
-        db.delete_user(modify_user)
+        await db.aio.delete_user(modify_user)
+        credentials.invalidate(modify_user)
         await callback.message.answer(msg.ACC_DELETE,
                                       reply_markup=kb.acc_delete())
     else:
         await callback.message.answer(msg.ACC_NOT_FOUND)
-    modify_user = 0
+    await dp.current_state().reset_data()
     await dp.current_state().set_state(msg.ADMIN)
 
 
 @dp.message_handler(commands=['show_active_users'], state=msg.ADMIN)
 async def show_active_users(message: Message):
     """Shows all users with launched scanner"""
-    if users:
-        for user_id in users:
-            start_time = db.select_data(user_id, db.ACCOUNT, db.START_TIME)[0]
-            last_request = db.select_data(user_id, db.ACCOUNT,
-                                          db.LAST_REQUEST)[0]
+    active_users = await get_active_users()
+    if active_users:
+        for user_id in active_users:
+            start_time, last_request = await db.aio.select_data(
+                user_id, db.ACCOUNT, f'{db.START_TIME}, {db.LAST_REQUEST}')
             await message.answer(f'{user_id} [{start_time}] [{last_request}]')
     else:
         await message.answer(msg.NO_ACTIVE_USERS)
@@ -400,8 +528,35 @@ async def show_active_users(message: Message):
 @dp.message_handler(commands=['show_ready_users'], state=msg.ADMIN)
 async def show_ready_users(message: Message):
     """Shows all users with filled data"""
-    ready_users = db.get_ready_users()
+    ready_users = await db.aio.get_ready_users()
     if ready_users:
         await message.answer(' '.join(str(user) for user in ready_users))
     else:
         await message.answer(msg.NO_READY_USERS)
+
+
+@dp.message_handler(commands=['show_cadence'], state=msg.ADMIN)
+async def show_cadence(message: Message):
+    """Shows learned polling cadence: interval factors by hour of the day
+    and by weekday of the scanned date"""
+    await message.answer(CADENCE.report())
+
+
+@dp.message_handler(commands=['profile'], state=msg.ADMIN)
+async def profile(message: Message):
+    """Samples stacks of the event loop for N seconds: /profile N. Shows the
+    hottest functions, or sends stacks for a flame graph: /profile N flame"""
+    args = message.get_args().split()
+    seconds = int(args[0]) if args and args[0].isdigit() else PROFILE_SECONDS
+    seconds = min(max(seconds, 1), MAX_PROFILE_SECONDS)
+    await message.answer(msg.profile_started(seconds))
+    # Sampling thread reads stack of the loop thread while the loop runs
+    stacks = await asyncio.get_running_loop().run_in_executor(
+        None, metrics.sample_stacks, threading.get_ident(), seconds)
+    if 'flame' in args:
+        await message.answer_document(InputFile(
+            BytesIO(metrics.collapsed_stacks(stacks).encode()),
+            filename='profile.folded'))
+    else:
+        await message.answer(
+            metrics.top_functions(stacks)[:MAX_MESSAGE_LENGTH])
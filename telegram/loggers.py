@@ -1,4 +1,10 @@
+import atexit
 import logging
+import queue
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener
+
+from metrics import Counter, Timer
 
 CRITICAL = 50
 ERROR = 40
@@ -7,36 +13,106 @@ INFO = 20
 DEBUG = 10
 NOTSET = 0
 
+LOGS_DIR = './telegram/logs'
+QUEUE_SIZE = 10000  # Records waiting for the listener thread
+MAX_OPEN_FILES = 128  # Per-user log files kept open at once
+
+DROPPED_RECORDS = Counter('log_records_dropped_total',
+                          'Log records dropped because the queue was full')
+
+
+class UserFileHandler(logging.Handler):
+    """
+    Writes every record into the file of its user. Keeps a bounded number of
+    files open and closes the least recently used one.
+    """
+
+    def __init__(self, max_open_files: int = MAX_OPEN_FILES):
+        super().__init__()
+        self.max_open_files = max_open_files
+        self.files: OrderedDict[int, logging.FileHandler] = OrderedDict()
+
+    def emit(self, record: logging.LogRecord):
+        # Errors must not reach the listener thread, which would stop
+        try:
+            user_id = getattr(record, 'user_id', 0)
+            file_handler = self.files.get(user_id)
+            if file_handler is None:
+                file_handler = logging.FileHandler(
+                    filename=f'{LOGS_DIR}/{str(user_id)}.log',
+                    encoding='utf-8')
+                file_handler.setFormatter(self.formatter)
+                self.files[user_id] = file_handler
+                if len(self.files) > self.max_open_files:
+                    _, oldest = self.files.popitem(last=False)
+                    oldest.close()
+            else:
+                self.files.move_to_end(user_id)
+            file_handler.emit(record)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        while self.files:
+            _, file_handler = self.files.popitem()
+            file_handler.close()
+        super().close()
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    Puts records into a bounded queue. Drops records when the queue is full
+    instead of blocking the event loop.
+    """
+
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED_RECORDS.inc()
+
+
 logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger()
 
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+user_file_handler = UserFileHandler()
+user_file_handler.setFormatter(formatter)
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(formatter)
+
+# Files are written by the listener thread, so log() only puts a record into
+# the queue
+queue_handler = BoundedQueueHandler(queue.Queue(QUEUE_SIZE))
+listener = QueueListener(queue_handler.queue, user_file_handler,
+                         console_handler)
+listener.start()
 
+logger = logging.getLogger('users')
+logger.setLevel(logging.INFO)
+logger.propagate = False
+logger.addHandler(queue_handler)
+
+
+@Timer('loggers.log')
 def log(user_id: int, message: str = None, level: int = DEBUG):
     """
-    Creates custom logger with user_id, message (optional), level.
+    Logs message (optional) with level into the file of user_id.
     Logging filename is the same as user id.
     """
+    logger.log(level, message, exc_info=level >= ERROR,
+               extra={'user_id': user_id})
+
+
+def shutdown():
+    """Writes all queued records and closes log files"""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+        user_file_handler.close()
+
 
-    # Remove previous FileHandler
-    for handler in logger.handlers:
-        if isinstance(handler, logging.FileHandler):
-            logger.handlers.remove(handler)
-
-    # Initialize and add new FileHandler
-    file_handler = logging.FileHandler(
-        filename=f'./telegram/logs/{str(user_id)}.log', encoding='utf-8')
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
-
-    # Set level
-    if level == DEBUG:
-        logger.debug(message)
-    elif level == INFO:
-        logger.info(message)
-    elif level == WARNING:
-        logger.warning(message)
-    elif level == ERROR:
-        logger.error(message, exc_info=True)
-    elif level == CRITICAL:
-        logger.critical(message, exc_info=True)
+atexit.register(shutdown)
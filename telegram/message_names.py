@@ -1,4 +1,4 @@
-from typing import Callable, Coroutine
+from typing import Callable, Coroutine, List
 
 import db
 import telegram.keyboards as kb
@@ -20,6 +20,9 @@ ADMIN_HELP = '/user\n' \
              '/show_active_users\n' \
              '/show_ready_users\n' \
              '/start_ready_users\n' \
+             '/show_cadence\n' \
+             '/show_schedule\n' \
+             '/profile\n' \
              '/admin_stop\n'
 
 # Account
@@ -93,10 +96,28 @@ def successful_appointment(year: str, month: str, day: str, time: str) -> str:
     return f'Появилось свободное окно: {year}/{month}/{day}. {time}.'
 
 
+def extra_appointments(year: str, month: str, day: str,
+                       times: List[str]) -> str:
+    return f'Созданы дополнительные записи: {year}/{month}/{day}. ' \
+           f'{", ".join(times)}. Отмените лишние на сайте Almaviva.'
+
+
 def admin_start_user(user_id: int) -> str:
     return f'{user_id} запущен'
 
 
+def admin_start_users(count: int) -> str:
+    return f'Запущено пользователей: {count}'
+
+
+def reboot_progress(done: int, total: int) -> str:
+    return f'Перезагружено пользователей: {done} из {total}'
+
+
+def profile_started(seconds: int) -> str:
+    return f'Профилирование: {seconds} с'
+
+
 def admin_user_ban(user_id: int) -> str:
     return f'{user_id} забанен'
 
@@ -108,10 +129,11 @@ def admin_user_unban(user_id: int) -> str:
 def check_scan(scan_status: Callable) -> Callable[[Message], Coroutine]:
     """Decorator for stop scanning and check scanning"""
     async def wrapper(message: Message):
-        user_id_exists = db.user_id_exists(message.from_user.id, db.ACCOUNT)
+        user_id_exists = await db.aio.user_id_exists(message.from_user.id,
+                                                     db.ACCOUNT)
         if user_id_exists:
-            is_active = db.select_data(message.from_user.id, db.ACCOUNT,
-                                       db.IS_ACTIVE)[0]
+            is_active = (await db.aio.select_data(
+                message.from_user.id, db.ACCOUNT, db.IS_ACTIVE))[0]
             if is_active:
                 await scan_status(message)
             else:
@@ -124,8 +146,8 @@ def check_scan(scan_status: Callable) -> Callable[[Message], Coroutine]:
 
 @check_scan
 async def show_last_request(message: Message):
-    last_request = db.select_data(message.from_user.id, db.ACCOUNT,
-                                  db.LAST_REQUEST)[0]
+    last_request = (await db.aio.select_data(message.from_user.id, db.ACCOUNT,
+                                             db.LAST_REQUEST))[0]
     msg = f'Сканирование в процессе. Последнее время опроса: {last_request}'
     await message.answer(msg)
 
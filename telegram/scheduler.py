@@ -1,45 +1,300 @@
+import heapq
+import inspect
+import time
+from datetime import datetime, timedelta, tzinfo
+from itertools import count
+from random import uniform
+from typing import Callable, Dict, FrozenSet, List, Tuple
+
 import asyncio
-import schedule
+import db
+from aiogram.utils.exceptions import TelegramAPIError
+from encrypting.cache import credentials
+from scanner import AUTH, MOSCOW_TZ, REDIS_CLIENT
+from scanner.events import node_id
 from . import loggers
 from . import message_names as msg
-from .bot import cancel_task, create_task, users
-from asyncio.exceptions import CancelledError
+from aiogram.types import Message
+from .bot import bot, dp, ADMIN_ID, cancel_tasks, create_tasks, \
+    get_active_users
 
-# Users with launched scanner
-active_users = {}
+WAVE_SIZE = 20  # users restarted at once
+WAVE_PAUSE = (5, 15)  # bounds of random pause in seconds between waves
+REPORTS = 4  # progress messages to admin during a restart
+PRUNE_INTERVAL = 300  # seconds between drops of expired credentials
+REFRESH_INTERVAL = 30  # seconds between checks of expiring auth tokens
+RERUN_LOCK = 'scan:rerun'  # replica of the bot which restarts users
+RERUN_LOCK_TTL = 3600  # seconds, longer than a restart, shorter than a day
 
+# Bounds of cron fields: minute, hour, day of month, month, day of week
+CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
 
-async def run_schedule():
-    while True:
-        schedule.run_pending()
-        await asyncio.sleep(15)
+
+def parse_field(field: str, low: int, high: int) -> FrozenSet[int]:
+    """Parses one cron field: '*', '5', '1-5', '*/15', '0-30/10' or comma
+    separated list of them"""
+    values = set()
+    for part in field.split(','):
+        value_range, _, step = part.partition('/')
+        if value_range == '*':
+            start, end = low, high
+        elif '-' in value_range:
+            start, end = map(int, value_range.split('-'))
+        else:
+            start = end = int(value_range)
+        if not low <= start <= end <= high + (high == 6):
+            raise ValueError(f'Wrong cron field: {field}')
+        values.update(range(start, end + 1, int(step or 1)))
+    # Sunday is both 0 and 7 in day of week
+    if high == 6 and 7 in values:
+        values.discard(7)
+        values.add(0)
+    return frozenset(values)
+
+
+class Cron:
+    """Five-field cron expression: minute, hour, day of month, month and day
+    of week (0 is Sunday) in the given timezone"""
+
+    def __init__(self, expression: str, tz: tzinfo):
+        fields = expression.split()
+        if len(fields) != len(CRON_FIELDS):
+            raise ValueError(f'Wrong cron expression: {expression}')
+        self.expression = expression
+        self.tz = tz
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            parse_field(field, *bounds)
+            for field, bounds in zip(fields, CRON_FIELDS))
+        # As in cron, restricted day of month and day of week match either
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def __repr__(self) -> str:
+        return f'Cron({self.expression!r})'
+
+    def day_matches(self, moment: datetime) -> bool:
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, timestamp: float) -> float:
+        """Returns:
+            Unix time of the first matching minute after timestamp.
+        """
+        moment = datetime.fromtimestamp(timestamp, self.tz).replace(
+            second=0, microsecond=0) + timedelta(minutes=1)
+        last_year = moment.year + 4
+        # Skips whole months, days and hours which don't match
+        while moment.year <= last_year:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0)
+                          + timedelta(days=32)).replace(day=1)
+            elif not self.day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment.timestamp()
+        raise ValueError(f'Cron expression never matches: {self.expression}')
+
+
+class Every:
+    """Fixed interval in seconds"""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+    def __repr__(self) -> str:
+        return f'Every({self.seconds})'
+
+    def next_after(self, timestamp: float) -> float:
+        return timestamp + self.seconds
+
+
+class Job:
+    """Scheduled function and timing of its runs"""
+
+    def __init__(self, name: str, func: Callable, trigger: Cron | Every):
+        self.name = name
+        self.func = func
+        self.trigger = trigger
+        self.due = 0.0  # Unix time of the next run
+        self.task: asyncio.Task | None = None
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0  # Runs missed because the previous one was running
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.max_delay = 0.0  # The latest start after due time
+
+    def report(self) -> str:
+        mean = self.total_duration / self.runs if self.runs else 0
+        due = datetime.fromtimestamp(self.due, MOSCOW_TZ).strftime(
+            '%m/%d %H:%M:%S')
+        return (f'{self.name} {self.trigger}: next {due}, runs {self.runs}, '
+                f'failures {self.failures}, skipped {self.skipped}, '
+                f'duration last/mean/max {self.last_duration:.3f}/'
+                f'{mean:.3f}/{self.max_duration:.3f} s, '
+                f'max delay {self.max_delay:.3f} s')
 
 
-async def stop_active_users():
-    global active_users
-    active_users = {user_id for user_id in users}
-    for user in active_users:
+class Scheduler:
+    """Runs jobs at their due time from a heap ordered by it. Every run of a
+    job is awaited in its own task, so a long job doesn't delay the others,
+    and a job never overlaps with its previous run."""
+
+    def __init__(self):
+        self.jobs: Dict[str, Job] = {}
+        # (due time, order of adding, job). Outdated entries are skipped
+        self.queue: List[Tuple[float, int, Job]] = []
+        self._order = count()
+        self._wakeup = asyncio.Event()
+
+    def add(self, name: str, func: Callable, trigger: Cron | Every) -> Job:
+        """Schedules func, coroutine function or plain function, by
+        trigger"""
+        job = Job(name, func, trigger)
+        self.jobs[name] = job
+        self._push(job, trigger.next_after(time.time()))
+        return job
+
+    def cron(self, name: str, func: Callable, expression: str,
+             tz: tzinfo = MOSCOW_TZ) -> Job:
+        return self.add(name, func, Cron(expression, tz))
+
+    def every(self, name: str, func: Callable, seconds: float) -> Job:
+        return self.add(name, func, Every(seconds))
+
+    def remove(self, name: str):
+        self.jobs.pop(name, None)
+
+    def _push(self, job: Job, due: float):
+        job.due = due
+        heapq.heappush(self.queue, (due, next(self._order), job))
+        if self.queue[0][2] is job:
+            self._wakeup.set()
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            if not self.queue:
+                await self._wakeup.wait()
+                continue
+            due, _, job = self.queue[0]
+            if self.jobs.get(job.name) is not job or job.due != due:
+                heapq.heappop(self.queue)
+                continue
+            delay = due - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self.queue)
+            if job.task is not None and not job.task.done():
+                job.skipped += 1
+            else:
+                job.task = asyncio.create_task(self._run_job(job, due))
+            # Next due time doesn't drift with the job duration. Runs missed
+            # while the loop was blocked are not repeated
+            next_due = job.trigger.next_after(due)
+            if next_due <= time.time():
+                next_due = job.trigger.next_after(time.time())
+            self._push(job, next_due)
+
+    async def _run_job(self, job: Job, due: float):
+        start = time.perf_counter()
+        job.max_delay = max(job.max_delay, time.time() - due)
         try:
-            await cancel_task(user)
-        # Does nothing but preventing error message
-        except CancelledError:
-            pass
+            result = job.func()
+            if inspect.isawaitable(result):
+                await result
+        except Exception as error:
+            job.failures += 1
+            loggers.log(0, f'Job {job.name} failed: {error!r}',
+                        loggers.ERROR)
+        finally:
+            duration = time.perf_counter() - start
+            job.runs += 1
+            job.last_duration = duration
+            job.total_duration += duration
+            job.max_duration = max(job.max_duration, duration)
+
+    def report(self) -> str:
+        """Returns:
+            Timing of all jobs for admin.
+        """
+        return '\n'.join(job.report() for job in self.jobs.values())
 
 
-async def run_active_users():
-    for user in active_users:
-        await create_task(user)
+async def notify_admin(text: str):
+    """Sends message to admin. Failed message doesn't stop restart"""
+    try:
+        await bot.send_message(ADMIN_ID, text)
+    except TelegramAPIError as error:
+        loggers.log(ADMIN_ID, str(error), loggers.WARNING)
 
 
-def schedule_rerun():
-    global active_users
+async def restart_active_users():
+    """Restarts active users in small waves with random pauses between them,
+    so new scanners don't load database and Almaviva all at once, and every
+    user is offline only for its own wave"""
     system_user = 0
     loggers.log(system_user, msg.REBOOT, loggers.WARNING)
-    asyncio.ensure_future(stop_active_users())
-    asyncio.ensure_future(run_active_users())
-    active_users.clear()
+    await notify_admin(msg.REBOOT)
+    restarting = sorted(await get_active_users())
+    total = len(restarting)
+    reported = 0
+    for start in range(0, total, WAVE_SIZE):
+        # Skip users who have stopped scanning since the restart began
+        active_users = await get_active_users()
+        wave = [user_id for user_id in restarting[start:start + WAVE_SIZE]
+                if user_id in active_users]
+        await cancel_tasks(wave)
+        await create_tasks(wave)
+        done = min(start + WAVE_SIZE, total)
+        if done * REPORTS // total > reported:
+            reported = done * REPORTS // total
+            await notify_admin(msg.reboot_progress(done, total))
+        if done < total:
+            await asyncio.sleep(uniform(*WAVE_PAUSE))
 
 
+async def rerun():
+    """Restarts active users once for all replicas of the bot. The replica
+    which sets the lock first does it, the lock expires by itself"""
+    if await REDIS_CLIENT.set(RERUN_LOCK, node_id(), ex=RERUN_LOCK_TTL,
+                              nx=True):
+        await restart_active_users()
+
+
+def maintenance_jobs(scheduler: Scheduler):
+    """Schedules routine jobs of every bot process"""
+    # Write buffered last requests and attempts
+    scheduler.every('flush_buffer', db.aio.flush_buffer,
+                    db.aio.FLUSH_INTERVAL)
+    scheduler.every('prune_credentials', credentials.prune, PRUNE_INTERVAL)
+    scheduler.every('refresh_tokens', AUTH.refresh_expiring, REFRESH_INTERVAL)
+
+
+SCHEDULER = Scheduler()
 # Restarts all active users. Start date is set up for tomorrow every rerun to
 # prevent appointing to previous dates.
-schedule.every().day.at('08:00').do(schedule_rerun)
+SCHEDULER.cron('rerun', rerun, '0 8 * * *')
+
+
+async def run_schedule():
+    maintenance_jobs(SCHEDULER)
+    await SCHEDULER.run()
+
+
+@dp.message_handler(commands=['show_schedule'], state=msg.ADMIN)
+async def show_schedule(message: Message):
+    """Shows scheduled jobs and timing of their runs"""
+    await message.answer(SCHEDULER.report())
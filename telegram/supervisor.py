@@ -0,0 +1,110 @@
+from collections import Counter
+from typing import Awaitable, Callable, Dict, Iterable, Iterator
+
+import asyncio
+from . import loggers
+
+MAX_RESTARTS = 3  # restarts of a crashed task before giving up
+RESTART_DELAY = 5  # seconds before restart of a crashed task
+
+
+class TaskSupervisor:
+    """Keeps one task of every user. Finished tasks remove themselves in done
+    callbacks, so starting and stopping a user costs O(1) and bulk
+    operations are linear. Crashed task is restarted up to max_restarts
+    times, so run must not raise after its work is done."""
+
+    def __init__(self, run: Callable[[int], Awaitable],
+                 on_failure: Callable[[int], Awaitable] | None = None,
+                 max_restarts: int = MAX_RESTARTS,
+                 restart_delay: float = RESTART_DELAY):
+        """
+        Args:
+            run: makes coroutine of user's task
+            on_failure: called with user id when restarts are exhausted
+            max_restarts: restarts of a crashed task before giving up
+            restart_delay: seconds before restart of a crashed task
+        """
+        self.run = run
+        self.on_failure = on_failure
+        self.max_restarts = max_restarts
+        self.restart_delay = restart_delay
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self.restarts = Counter()
+        self._pending: Dict[int, asyncio.TimerHandle] = {}
+        self._callbacks = set()  # Running on_failure tasks
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.tasks or user_id in self._pending
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(tuple(self.tasks) + tuple(self._pending))
+
+    def __len__(self) -> int:
+        return len(self.tasks) + len(self._pending)
+
+    def start(self, user_id: int) -> asyncio.Task:
+        """Starts user's task unless it is already running"""
+        task = self.tasks.get(user_id)
+        if task is not None:
+            return task
+        self.restarts.pop(user_id, None)
+        return self._spawn(user_id)
+
+    def _spawn(self, user_id: int) -> asyncio.Task:
+        pending = self._pending.pop(user_id, None)
+        if pending is not None:
+            pending.cancel()
+        task = asyncio.create_task(self.run(user_id))
+        self.tasks[user_id] = task
+        task.add_done_callback(lambda done: self._done(user_id, done))
+        return task
+
+    def stop(self, user_id: int) -> bool:
+        """Cancels user's task. The task can stop itself.
+        Returns:
+            True if the user had a task.
+        """
+        self.restarts.pop(user_id, None)
+        pending = self._pending.pop(user_id, None)
+        if pending is not None:
+            pending.cancel()
+        task = self.tasks.pop(user_id, None)
+        # Cancelling itself would interrupt the rest of the task's cleanup
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        return task is not None or pending is not None
+
+    def start_many(self, user_ids: Iterable[int]):
+        for user_id in user_ids:
+            self.start(user_id)
+
+    def stop_many(self, user_ids: Iterable[int]):
+        for user_id in tuple(user_ids):
+            self.stop(user_id)
+
+    def _done(self, user_id: int, task: asyncio.Task):
+        # Stopped task or the user has a newer task already
+        if self.tasks.get(user_id) is not task:
+            return
+        del self.tasks[user_id]
+        if task.cancelled() or task.exception() is None:
+            return
+        error = task.exception()
+        loggers.log(user_id, f'Task crashed: {error!r}', loggers.WARNING)
+        if self.restarts[user_id] < self.max_restarts:
+            self.restarts[user_id] += 1
+            self._pending[user_id] = asyncio.get_running_loop().call_later(
+                self.restart_delay, self._spawn, user_id)
+        else:
+            self.restarts.pop(user_id, None)
+            if self.on_failure is not None:
+                callback = asyncio.create_task(self.on_failure(user_id))
+                self._callbacks.add(callback)
+                callback.add_done_callback(self._callbacks.discard)
+
+    async def close(self):
+        """Cancels all tasks and waits until they finish"""
+        tasks = tuple(self.tasks.values())
+        self.stop_many(tuple(self))
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,90 @@
+import hmac
+import time
+from typing import Set
+
+import asyncio
+import metrics
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+from . import loggers
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+UPDATE_SECONDS = metrics.Histogram(
+    'telegram_update_seconds', 'Time of handling Telegram updates from '
+    'webhook', ('result',))
+PENDING_UPDATES = metrics.Gauge(
+    'telegram_pending_updates', 'Webhook updates accepted but not handled '
+    'yet')
+
+
+class WebhookHandler:
+    """Receives Telegram updates by webhook. Every update is acknowledged at
+    once and handled in its own task, at most concurrency of them at a time,
+    so a slow handler never makes Telegram resend the update."""
+
+    def __init__(self, dispatcher: Dispatcher, secret: str,
+                 concurrency: int):
+        """
+        Args:
+            dispatcher: handles updates
+            secret: last part of the webhook path and secret token which
+                Telegram sends in every request
+            concurrency: updates handled at once
+        """
+        self.dispatcher = dispatcher
+        self.secret = secret
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks: Set[asyncio.Task] = set()
+
+    def is_authorized(self, request: web.Request) -> bool:
+        """Returns:
+            True if both secret path and secret header are right.
+        """
+        return (hmac.compare_digest(request.match_info.get('secret', ''),
+                                    self.secret)
+                and hmac.compare_digest(request.headers.get(SECRET_HEADER, ''),
+                                        self.secret))
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self.is_authorized(request):
+            raise web.HTTPForbidden()
+        try:
+            update = Update(**await request.json())
+        except ValueError:
+            raise web.HTTPBadRequest()
+        # Handlers get bot and dispatcher from context of the task
+        Dispatcher.set_current(self.dispatcher)
+        Bot.set_current(self.dispatcher.bot)
+        task = asyncio.create_task(self.process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+        PENDING_UPDATES.set(len(self._tasks))
+        return web.Response()
+
+    def _done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        PENDING_UPDATES.set(len(self._tasks))
+
+    async def process(self, update: Update):
+        async with self._semaphore:
+            start = time.perf_counter()
+            result = 'ok'
+            try:
+                await self.dispatcher.process_update(update)
+            except Exception as error:
+                result = 'error'
+                loggers.log(0, f'Update {update.update_id} failed: {error!r}',
+                            loggers.ERROR)
+            UPDATE_SECONDS.observe(time.perf_counter() - start, result=result)
+
+    async def close(self):
+        """Waits for accepted updates before shutdown"""
+        if self._tasks:
+            await asyncio.wait(tuple(self._tasks))
+
+
+def setup_routes(app: web.Application, handler: WebhookHandler, path: str):
+    """Adds webhook route to app. Path ends with the secret"""
+    app.router.add_post(f'{path.rstrip("/")}/{{secret}}', handler.handle)
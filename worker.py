@@ -0,0 +1,47 @@
+import asyncio
+import db
+import scanner
+from cluster import JobQueue, Worker
+from cluster.jobs import ScanResult
+from encrypting.cache import credentials
+from scanner.events import node_id
+from telegram.scheduler import Scheduler, maintenance_jobs
+
+
+async def scan(user_id: int) -> ScanResult:
+    # Bot drops cached credentials of its own process only. The user may
+    # have changed email, password or city since this worker cached them
+    credentials.invalidate(user_id)
+    return await scanner.Appointment(user_id).run_scanning()
+
+
+async def deactivate(user_id: int):
+    """Marks user not scanning after the scan has crashed too many times,
+    as the bot does in local mode"""
+    await db.aio.update_users((user_id,), db.ACCOUNT, (db.IS_ACTIVE,),
+                              (False,))
+
+
+async def main():
+    await scanner.startup()
+    scheduler = Scheduler()
+    maintenance_jobs(scheduler)
+    maintenance = asyncio.create_task(scheduler.run())
+    worker = Worker(JobQueue(scanner.REDIS_CLIENT), node_id(), scan,
+                    on_failure=deactivate)
+    try:
+        await worker.run()
+    finally:
+        await worker.close()
+        maintenance.cancel()
+        await scanner.shutdown()
+
+
+if __name__ == '__main__':
+    # Scans users whose jobs are sent by main.py started with
+    # scan_mode='workers'. Workers must share Redis and run on the host of
+    # the database file
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass